@@ -0,0 +1,326 @@
+#!/usr/bin/python
+'''
+    Benchmarks for primo scheduler, event pipeline, process spawning, stdout
+    pipeline and config parsing. Child processes are stubs (/bin/true and the
+    spammer.py script), nothing else is needed.
+
+    Results are written as json, so runs of different versions can be compared:
+
+        python benchmarks/bench_primo.py --output before.json
+        python benchmarks/bench_primo.py --quick --only dispatch,parse
+'''
+import sys
+import os
+import io
+import time
+import json
+import shutil
+import platform
+import tempfile
+import contextlib
+import subprocess
+from optparse import OptionParser
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+import primo
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def result(name, params, **metrics):
+    return {'name': name, 'params': params, 'metrics': metrics}
+
+@contextlib.contextmanager
+def quiet():
+    # primo prints on the hot path, it must not be part of the measures
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def new_primo():
+    p = primo.Primo()
+    # the event journal is part of the pipeline being measured, but it must
+    # not end up in the json output
+    p.event_sink = primo.EventSink(open(os.devnull, 'w'))
+    return p
+
+def run_primo(p, duration):
+    p.schedule_callback(p.StopNow, duration)
+    with quiet():
+        p.run()
+
+#
+# Benchmarks. Each one returns a list of results
+#
+def bench_schedule(quick):
+    '''
+        heap throughput of Primo.schedule_callback and of popping the entries
+    '''
+    ret = []
+    for n in ((10000,) if quick else (10000, 100000)):
+        p = new_primo()
+        callback = lambda: None
+
+        t = time.perf_counter()
+        for i in range(n):
+            p.schedule_callback(callback, (i * 7919 % n) / 1000.0)
+        push = time.perf_counter() - t
+
+        t = time.perf_counter()
+        while p.schedule:
+            primo.heappop(p.schedule)
+        pop = time.perf_counter() - t
+
+        ret.append(result('schedule', {'callbacks': n},
+                          push_per_sec=n / push, pop_per_sec=n / pop))
+    return ret
+
+def bench_dispatch(quick):
+    '''
+        dispatch latency of Primo.run: how late the callbacks run compared
+        to when they were scheduled
+    '''
+    n = 200 if quick else 1000
+    spacing = 0.002
+    lateness = []
+
+    p = new_primo()
+    base = time.monotonic()
+
+    def callback(intended):
+        lateness.append(time.monotonic() - intended)
+
+    for i in range(n):
+        delay = 0.1 + i * spacing
+        p.schedule_callback(lambda intended=base + delay: callback(intended), delay)
+
+    run_primo(p, 0.2 + n * spacing)
+
+    return [result('dispatch', {'callbacks': n, 'spacing': spacing},
+                   dispatched=len(lateness),
+                   latency_p50=percentile(lateness, 50),
+                   latency_p99=percentile(lateness, 99),
+                   latency_max=max(lateness) if lateness else None)]
+
+def bench_timer_drift(quick):
+    '''
+        drift of EachXSeconds timers: where the last tick is compared to
+        first tick + N * interval
+    '''
+    interval = 0.05
+    duration = 2.0 if quick else 10.0
+    ticks = []
+
+    p = new_primo()
+    globals = {'ticks': ticks, 'monotonic': time.monotonic}
+    # started by run()
+    p.add_timer_listener(primo.EachXSecondsListener(globals, p, None, interval, '{ticks.append(monotonic())}'))
+
+    run_primo(p, duration)
+
+    if len(ticks) < 2:
+        return [result('timer_drift', {'interval': interval, 'duration': duration}, ticks=len(ticks))]
+
+    drift = ticks[-1] - (ticks[0] + (len(ticks) - 1) * interval)
+    return [result('timer_drift', {'interval': interval, 'duration': duration},
+                   ticks=len(ticks),
+                   expected_ticks=int(duration / interval),
+                   drift=drift,
+                   drift_per_tick=drift / (len(ticks) - 1))]
+
+def bench_raise_event(quick):
+    '''
+        cost of Primo.raise_process_event with N listeners running code
+    '''
+    ret = []
+    n = 2000 if quick else 20000
+
+    for listeners in (0, 1, 10, 100):
+        p = new_primo()
+        process = primo.Process(p)
+        for i in range(listeners):
+            process.add_listener(
+                primo.RunCodeOnEventListener('after_start', primo.StringCodeAdapter(None, 'ret = 1')))
+
+        t = time.perf_counter()
+        for i in range(n):
+            p.raise_process_event('after_start', process)
+        elapsed = time.perf_counter() - t
+
+        ret.append(result('raise_event', {'listeners': listeners, 'events': n},
+                          per_event=elapsed / n,
+                          per_listener_call=elapsed / (n * listeners) if listeners else None))
+    return ret
+
+def stub_process(p, bin, args):
+    process = primo.Process(p)
+    process.path, process.bin = os.path.split(bin)
+    process.command_line_parameters = args
+    process.id = os.path.basename(bin)
+    return process
+
+def bench_spawn(quick):
+    '''
+        spawn rate of Process.StartNow
+    '''
+    n = 50 if quick else 500
+    bin = '/bin/true' if os.path.exists('/bin/true') else sys.executable
+    args = [] if bin == '/bin/true' else ['-c', 'pass']
+
+    p = new_primo()
+    process = stub_process(p, bin, args)
+
+    elapsed = 0
+    for i in range(n):
+        process.running = False
+        t = time.perf_counter()
+        with quiet():
+            process.StartNow()
+        elapsed += time.perf_counter() - t
+
+        process.process_obj.wait()
+        del p.schedule[:]
+
+    return [result('spawn', {'bin': bin, 'spawns': n},
+                   spawns_per_sec=n / elapsed,
+                   per_spawn=elapsed / n)]
+
+def bench_stdout(quick):
+    '''
+        throughput of the StdoutToFile pipeline, with and without rotation
+    '''
+    ret = []
+    megabytes = 20 if quick else 200
+    tmp = tempfile.mkdtemp(prefix='primo_bench_')
+    spammer = os.path.join(BENCHMARKS_DIR, 'spammer.py')
+
+    try:
+        for max_bytes, compress in ((None, None), (4 * 1024 * 1024, None), (4 * 1024 * 1024, 'gzip')):
+            path = os.path.join(tmp, 'out_%s_%s.log' % (max_bytes, compress))
+
+            p = new_primo()
+            process = stub_process(p, sys.executable, ['"%s"' % spammer, str(megabytes)])
+            dst = primo.RotatingFile(path, 'wb', max_bytes, 3, compress)
+            process.setup_stdout(dst)
+
+            t = time.perf_counter()
+            with quiet():
+                process.StartNow()
+            process.process_obj.wait()
+
+            # the pump thread may still be copying
+            expected = megabytes * 1024 * 1024
+            while dst.written < expected:
+                time.sleep(0.001)
+            elapsed = time.perf_counter() - t
+
+            # compression isn't part of the measure, but must be done before rmtree
+            while dst.archiving:
+                time.sleep(0.01)
+
+            ret.append(result('stdout', {'megabytes': megabytes, 'max_bytes': max_bytes, 'compress': compress},
+                              mb_per_sec=megabytes / elapsed,
+                              rotations=dst.rotations))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return ret
+
+def generate_config(n):
+    out = io.StringIO()
+    out.write('<?xml version="1.0"?>\n<Primo>\n <Parameters>\n')
+    out.write('  <Parameter name="bin_path" value="/bin"/>\n')
+    out.write('  <Parameter name="interval" value="60"/>\n')
+    out.write(' </Parameters>\n')
+    for i in range(n):
+        out.write(' <Process path="{bin_path}" bin="true" id="p%d">\n' % i)
+        out.write('  <CommandLineAdd value="--worker {%d * 2}"/>\n' % i)
+        out.write('  <AutoStart/>\n')
+        out.write('  <OnEvent event="after_finish" action="{process.Start()}"/>\n')
+        out.write('  <EachXSeconds interval="{interval}" action="{process.Start()}"/>\n')
+        out.write(' </Process>\n')
+    out.write('</Primo>\n')
+    return out.getvalue()
+
+def bench_parse(quick):
+    '''
+        XmlConfigParser time for generated configs with N processes, and
+        the time to start their timer listeners
+    '''
+    ret = []
+    for n in ((10, 100, 1000) if quick else (10, 100, 1000, 10000)):
+        config = generate_config(n)
+
+        t = time.perf_counter()
+        p = primo.XmlConfigParser({}).parse_string(config)
+        elapsed = time.perf_counter() - t
+
+        # timer listeners are built by the parser, started when primo runs
+        t = time.perf_counter()
+        p.start_timer_listeners()
+        listeners = time.perf_counter() - t
+
+        assert len(p.processes) == n
+        ret.append(result('parse', {'processes': n, 'bytes': len(config)},
+                          seconds=elapsed, per_process=elapsed / n, listeners_seconds=listeners))
+    return ret
+
+BENCHMARKS = [
+    ('schedule', bench_schedule),
+    ('dispatch', bench_dispatch),
+    ('timer_drift', bench_timer_drift),
+    ('raise_event', bench_raise_event),
+    ('spawn', bench_spawn),
+    ('stdout', bench_stdout),
+    ('parse', bench_parse),
+]
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--quick', dest='quick', action='store_true', default=False,
+                      help='smaller sizes and shorter runs')
+    parser.add_option('--only', dest='only',
+                      help='comma separated benchmark names: %s' % ', '.join(x[0] for x in BENCHMARKS))
+    parser.add_option('--output', dest='output', help='json file, stdout if not set')
+    options, _ = parser.parse_args()
+
+    only = options.only.split(',') if options.only else None
+
+    results = []
+    for name, func in BENCHMARKS:
+        if only and name not in only:
+            continue
+        sys.stderr.write('running %s...\n' % name)
+        results.extend(func(options.quick))
+
+    report = {
+        'meta': {
+            'time': time.time(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'quick': options.quick,
+        },
+        'results': results,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main()
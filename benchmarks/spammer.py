@@ -0,0 +1,27 @@
+#!/usr/bin/python
+'''
+    Writes "megabytes" MB of log-like lines to stdout as fast as it can.
+    Child process used by the stdout throughput benchmark.
+
+    usage: spammer.py [megabytes]
+'''
+import sys
+
+def main():
+    megabytes = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    total = int(megabytes * 1024 * 1024)
+
+    line = b'2019-07-29 12:00:00 INFO spammer: ' + b'x' * 60 + b'\n'
+    chunk = line * (65536 // len(line))
+
+    out = sys.stdout.buffer
+    written = 0
+    while written < total:
+        data = chunk[:total - written]
+        out.write(data)
+        written += len(data)
+
+    out.flush()
+
+if __name__ == '__main__':
+    main()
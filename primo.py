@@ -1,17 +1,24 @@
 #!/usr/bin/python
 import sys
-import subprocess
 import time
+
+# see StartupProfile
+STARTUP_TIME = time.perf_counter()
+
 import os
 import functools
-import traceback
-import xml.sax
-import datetime
+import threading
+import collections
+import queue
 from heapq import heappop, heappush
-from pprint import pprint
-from optparse import OptionParser
 from io import StringIO
 
+#
+# Only what's needed to parse the config and start the main loop is
+# imported here, the rest is imported where it's used: primo startup time
+# counts when it's restarted in short lived containers
+#
+
 if sys.platform == 'win32':
     import winreg
 
@@ -40,6 +47,14 @@ class Process(object):
         self.id = None
         self.disabled = False
 
+        # used by Replace(): how to tell the new instance is ready and
+        # how long the old one has to exit before being killed
+        self.readiness_check = None
+        self.readiness_interval = 0.5
+        self.readiness_timeout = 30.0
+        self.stop_timeout = 10.0
+        self.replacing = False
+
         self.environ = os.environ        
 
         #
@@ -48,6 +63,12 @@ class Process(object):
         #
         self.stdout_dst = None
         self.stdin_src = None
+
+        # ProcessPipe feeding another process stdin, see StdoutToProcess
+        self.stdout_pipe = None
+
+        # CPU affinity, nice, I/O and scheduling class, see Placement
+        self.placement = None
         
         self.process_obj = None
         self.primo = primo
@@ -58,23 +79,41 @@ class Process(object):
     def add_listener(self, c):
         self.listeners.append(c)
 
+    def config_hash(self):
+        '''
+            identifies what would be run by StartNow, a journaled pid is only
+            adopted if the process config didn't change
+        '''
+        import hashlib
+
+        args = [getattr(x, 'string_code', x) for x in self.command_line_parameters]
+        return hashlib.sha1(repr((self.path, self.bin, args)).encode('utf-8')).hexdigest()[:16]
+
     def setup_stdin(self, stream):
         self.stdin_src = stream
 
     def setup_stdout(self, stream):
         self.stdout_dst = stream        
 
-    def StartNow(self):
+    def setup_stdout_pipe(self, pipe):
+        self.stdout_pipe = pipe
 
-        if self.running:
-            return
-        
-        bin = path_join(self.path, self.bin).encode(sys.getfilesystemencoding()).decode("utf-8")
+    def _pipeline_fds(self):
+        '''
+            (stdin, stdout) file descriptors when this process is part of a
+            pipeline, None where it isn't
+        '''
+        stdin_pipe = self.primo.pipes.get(self.id)
+        return (stdin_pipe.consumer_fd if stdin_pipe else None,
+                self.stdout_pipe.producer_fd if self.stdout_pipe else None)
+
+    def _bin(self):
+        return path_join(self.path, self.bin).encode(sys.getfilesystemencoding()).decode("utf-8")
+
+    def _spawn(self, bin, stdin=None, stdout=None):
+        import shlex
+        import subprocess
 
-        if self.disabled:
-            print('Process "%s (%s)" is disabled, can\'t StartNow' % (bin, self.id))
-            return
-        
         args = StringIO()
         args.write(bin)
         args.write(' '.encode(sys.getfilesystemencoding()).decode("utf-8"))
@@ -87,6 +126,49 @@ class Process(object):
                 
             args.write(' ')
 
+        args = args.getvalue()
+
+        # Windows takes the command line as is, on *nix it must be split
+        # into argv, otherwise the whole string becomes argv[0]
+        if sys.platform != 'win32':
+            args = shlex.split(args)
+
+        preexec_fn = self.placement.preexec_fn() if self.placement else None
+
+        return subprocess.Popen(args, executable=bin, stdin=stdin, stdout=stdout, env=self.environ,
+                                preexec_fn=preexec_fn)
+
+    def _pump_stdout(self, process_obj):
+        '''
+            copies the child stdout to stdout_dst in a separated thread, so
+            a long lived process doesn't lock primo
+        '''
+        def pump():
+            fd = process_obj.stdout.fileno()
+            while 1:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                self.stdout_dst.write(data)
+            process_obj.stdout.close()
+
+        t = threading.Thread(target=pump, name='stdout %s' % self.id)
+        t.daemon = True
+        t.start()
+
+    def StartNow(self):
+
+        import subprocess
+
+        if self.running:
+            return
+        
+        bin = self._bin()
+
+        if self.disabled:
+            self.primo.event_sink.emit('start_refused', self, reason='disabled')
+            return
+
         _in, _out = None, None
         #
         # In Windows, I got an error trying to write to stdin but not reading the stdout:
@@ -100,33 +182,32 @@ class Process(object):
 
         if self.stdout_dst:
             _out = subprocess.PIPE
+
+        # pipelines: the child gets the pipe itself, primo doesn't copy anything
+        stdin_fd, stdout_fd = self._pipeline_fds()
+        if stdin_fd is not None:
+            _in = stdin_fd
+        if stdout_fd is not None:
+            _out = stdout_fd
        
         self.primo.raise_process_event('before_start', self, 'after_start_cancel')
 
-        self.process_obj = subprocess.Popen(args.getvalue(), executable=bin, stdin=_in, stdout=_out, env=self.environ)
+        self.process_obj = self._spawn(bin, _in, _out)
 
-        # TODO: everything here is kept in memory during the operation
-        # TODO: this will lock primo, should be done in a separated thread
-        
-        if _in:
+        if self.primo.profile:
+            self.primo.profile.spawned()
+
+        if self.stdin_src:
+            # TODO: everything here is kept in memory during the operation
+            # TODO: this will lock primo, should be done in a separated thread
             # TODO: we're ignoring stderr
             ret = self.process_obj.communicate(self.stdin_src.read())[0]
             if self.stdout_dst:
                 self.stdout_dst.write(ret)
-        elif _out:
-            while 1:
-                ret = self.process_obj.stdout.read()
-
-                if not ret:
-                    if self.process_obj.poll() != None:
-                        break
-                    else:
-                        time.sleep(0.5) # TODO: hardcoded timer
-
-                self.stdout_dst.write(ret)
+        elif self.stdout_dst:
+            self._pump_stdout(self.process_obj)
 
         if self.stdin_src: self.stdin_src.close()
-        if self.stdout_dst: self.stdout_dst.close()       
         
         self.pid = self.process_obj.pid
         self.running = self.process_obj.poll() == None
@@ -151,11 +232,697 @@ class Process(object):
         return self.primo.schedule_callback(self.StartNow, 0)
 
     def Kill(self):
-        return self.primo.schedule_callback(self.KillNow, 0)            
+        return self.primo.schedule_callback(self.KillNow, 0)
+
+    def ReplaceNow(self):
+        '''
+            Starts a new instance alongside the running one, waits for the
+            readiness check and only then stops the old instance.
+        '''
+        import subprocess
+
+        if not self.running:
+            # nothing running, so there's no capacity gap to avoid
+            self.StartNow()
+            return
+
+        if self.replacing:
+            return
+
+        bin = self._bin()
+
+        if self.disabled:
+            self.primo.event_sink.emit('replace_refused', self, reason='disabled')
+            return
+
+        # stdin is consumed by the first instance, there's nothing left to
+        # feed a second one
+        if self.stdin_src:
+            self.primo.event_sink.emit('replace_refused', self, reason='stdin redirected')
+            return
+
+        self.primo.raise_process_event('before_replace', self, 'after_replace_cancel')
+
+        stdin_fd, stdout_fd = self._pipeline_fds()
+
+        if self.stdout_dst:
+            candidate = self._spawn(bin, stdin_fd, subprocess.PIPE)
+            self._pump_stdout(candidate)
+        else:
+            candidate = self._spawn(bin, stdin_fd, stdout_fd)
+        self.replacing = True
+
+        deadline = time.monotonic() + self.readiness_timeout
+        self.primo.schedule_callback(
+            functools.partial(self._ReplaceCheck, candidate, deadline),
+            self.readiness_interval)
+
+    def _ReplaceCheck(self, candidate, deadline):
+        if candidate.poll() != None:
+            self.primo.event_sink.emit('replace_failed', self, candidate=candidate.pid,
+                                       reason='finished before being ready', returncode=candidate.returncode)
+            self.replacing = False
+            self.primo.post_process_event('after_replace_failed', self)
+            return
+
+        ready = self.readiness_check(self.primo, self, candidate) if self.readiness_check else True
+
+        if not ready:
+            if time.monotonic() < deadline:
+                self.primo.schedule_callback(
+                    functools.partial(self._ReplaceCheck, candidate, deadline),
+                    self.readiness_interval)
+                return
+
+            self.primo.event_sink.emit('replace_failed', self, candidate=candidate.pid,
+                                       reason='not ready', timeout=self.readiness_timeout)
+            candidate.kill()
+            self.replacing = False
+            self.primo.post_process_event('after_replace_failed', self)
+            return
+
+        previous = self.process_obj
+        was_running = self.running
+
+        self.process_obj = candidate
+        self.pid = candidate.pid
+        self.running = True
+        self.replacing = False
+
+        if was_running:
+            # FinishMonitorListener is still polling process_obj, now
+            # it'll be polling the new instance
+            self._StopObj(previous)
+        else:
+            # the old instance finished while we were waiting, the finish
+            # monitor must be started again
+            self.primo.post_process_event('after_start', self)
+
+        self.primo.post_process_event('after_replace', self)
+
+    def _StopObj(self, process_obj):
+        process_obj.terminate()
+
+        def kill_if_alive():
+            if process_obj.poll() == None:
+                process_obj.kill()
+
+        self.primo.schedule_callback(kill_if_alive, self.stop_timeout)
+
+    def Replace(self):
+        return self.primo.schedule_callback(self.ReplaceNow, 0)
+
+def parse_size(s):
+    '''
+        >>> primo.parse_size('100M')
+        104857600
+    '''
+    s = s.strip()
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if s and s[-1].upper() in units:
+        return int(float(s[:-1]) * units[s[-1].upper()])
+    return int(s)
+
+class RotatingFile(object):
+    '''
+        Process stdout destination. When the file grows past max_bytes it's
+        renamed and a new one is opened, the renamed file becomes path.1
+        (path.1 becomes path.2 and so on, keeping "keep" files), optionally
+        gzip'ed. Shifting and compression run in a separated thread, so a
+        rotation costs a single rename to the process output pipeline.
+    '''
+    def __init__(self, path, mode, max_bytes=None, keep=5, compress=None):
+        if compress not in (None, 'gzip'):
+            raise Exception('Invalid compress value: ', compress)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.compress = compress
+
+        self.file = open(path, mode)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.written = 0
+
+        # writes come from the stdout pump threads
+        self.lock = threading.Lock()
+
+        self.rotations = 0
+        self.pending = []
+        self.archiving = False
+
+    def __repr__(self):
+        return '<RotatingFile path="%s" max_bytes=%s keep=%s compress=%s>' % \
+               (self.path, self.max_bytes, self.keep, self.compress)
+
+    def write(self, data):
+        if not data:
+            return
+
+        with self.lock:
+            if self.max_bytes and self.size and self.size + len(data) > self.max_bytes:
+                self._rotate()
+
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            self.written += len(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def _archive_name(self, n):
+        return '%s.%d%s' % (self.path, n, '.gz' if self.compress else '')
+
+    def _rotate(self):
+        self.file.close()
+
+        self.rotations += 1
+        rotated = '%s.rotated-%d' % (self.path, self.rotations)
+        os.rename(self.path, rotated)
+
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+        self.pending.append(rotated)
+        if not self.archiving:
+            self.archiving = True
+            # not a daemon thread, primo exit waits for the archive to be complete
+            threading.Thread(target=self._archiver, name='archiver %s' % self.path).start()
+
+    def _archiver(self):
+        while 1:
+            with self.lock:
+                if not self.pending:
+                    self.archiving = False
+                    return
+                rotated = self.pending.pop(0)
+
+            try:
+                self._archive(rotated)
+            except Exception as ex:
+                print('unexpected exception archiving "%s": %s' % (rotated, ex), file=sys.stderr)
+
+    def _archive(self, rotated):
+        import gzip
+        import shutil
+
+        if self.keep < 1:
+            os.remove(rotated)
+            return
+
+        if os.path.exists(self._archive_name(self.keep)):
+            os.remove(self._archive_name(self.keep))
+
+        for n in range(self.keep - 1, 0, -1):
+            if os.path.exists(self._archive_name(n)):
+                os.rename(self._archive_name(n), self._archive_name(n + 1))
+
+        if self.compress == 'gzip':
+            tmp = self._archive_name(1) + '.tmp'
+            with open(rotated, 'rb') as src:
+                with gzip.open(tmp, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+            os.rename(tmp, self._archive_name(1))
+            os.remove(rotated)
+        else:
+            os.rename(rotated, self._archive_name(1))
+
+def proc_start_time(pid):
+    '''
+        start time of pid (in clock ticks since boot) as seen in /proc/<pid>/stat,
+        None if there's no such process (or no /proc). Used to tell a pid apart
+        from a recycled one.
+    '''
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return None
+
+    # the command name may contain spaces and parenthesis, fields
+    # start after the last ")": state is field 3, starttime is field 22
+    fields = stat[stat.rfind(')') + 2:].split()
+    if fields[0] == 'Z':
+        return None
+    return int(fields[19])
+
+class AdoptedProcess(object):
+    '''
+        stands for a subprocess.Popen object when primo re-attaches to a process
+        started by a previous primo instance. It's not our child, so we can't
+        wait() for it and its return code is unknown (-1).
+    '''
+    def __init__(self, pid, start_time):
+        self.pid = pid
+        self.start_time = start_time
+        self.returncode = None
+
+    def __repr__(self):
+        return '<AdoptedProcess pid=%d>' % self.pid
+
+    def poll(self):
+        if self.returncode == None and proc_start_time(self.pid) != self.start_time:
+            self.returncode = -1
+        return self.returncode
+
+    def terminate(self):
+        import signal
+
+        if self.poll() == None:
+            os.kill(self.pid, signal.SIGTERM)
+
+    def kill(self):
+        import signal
+
+        if self.poll() == None:
+            os.kill(self.pid, signal.SIGKILL)
+
+class StateJournal(object):
+    '''
+        Append-only journal (json lines) of started and finished processes.
+        It's a global listener, on primo start the processes still running
+        since the last primo instance are adopted instead of started again.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def __repr__(self):
+        return '<StateJournal path="%s">' % self.path
+
+    def __call__(self, event, primo, process):
+        # adopted processes are written by adopt() itself
+        if event in ('after_start', 'after_replace'):
+            if process.running:
+                self.append({'event': 'start', 'id': process.id, 'pid': process.pid,
+                             'start_time': proc_start_time(process.pid),
+                             'config_hash': process.config_hash()})
+        elif event in ('after_finish', 'after_kill'):
+            self.append({'event': 'finish', 'id': process.id})
+
+    def append(self, record):
+        import json
+
+        if self.file is None:
+            self.file = open(self.path, 'a')
+
+        record['time'] = time.time()
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def load(self):
+        '''
+            returns the last record of each process id
+        '''
+        import json
+
+        last = {}
+        try:
+            f = open(self.path)
+        except (IOError, OSError):
+            return last
+
+        with f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # primo died while writing it
+                    continue
+                last[record['id']] = record
+
+        return last
+
+    def adopt(self, primo):
+        if not os.path.exists('/proc/self/stat'):
+            primo.event_sink.emit('warning', message='state journal needs /proc to adopt processes, ignoring it')
+            return
+
+        adopted = []
+        for id, record in self.load().items():
+            process = primo.processes.get(id)
+
+            if record['event'] != 'start' or not process or process.running:
+                continue
+
+            # their pipes died with the former primo instance
+            if process.stdin_src or process.stdout_dst or process.stdout_pipe or id in primo.pipes:
+                continue
+
+            if record['config_hash'] != process.config_hash():
+                primo.event_sink.emit('adopt_refused', process, pid=record['pid'], reason='config changed')
+                continue
+
+            if record['start_time'] is None or proc_start_time(record['pid']) != record['start_time']:
+                continue
+
+            process.process_obj = AdoptedProcess(record['pid'], record['start_time'])
+            process.pid = record['pid']
+            process.running = True
+            adopted.append(record)
+
+            primo.post_process_event('after_adopt', process)
+
+        self.compact(adopted)
+
+    def compact(self, records):
+        '''
+            replaces the journal by records, the adopted processes are the
+            only ones still relevant. The journal is replaced atomically, so
+            it's never lost if primo dies meanwhile
+        '''
+        import json
+
+        if self.file:
+            self.file.close()
+            self.file = None
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+class EventSink(object):
+    '''
+        Structured event journal: one json object per line, with ts, event,
+        process, pid, latency and any extra field. Events are queued and
+        written in batches by a background thread. The queue is bounded, when
+        it's full (slow disk) events are dropped and counted, the main loop
+        never waits for the journal.
+    '''
+    def __init__(self, stream, max_queue=10000, batch_size=512, flush_interval=0.2):
+        self.stream = stream
+        self.queue = queue.Queue(max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # approximate, updated without locks
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.written = 0
+
+        self.thread = None
+
+    def __repr__(self):
+        return '<EventSink stream=%s>' % getattr(self.stream, 'name', self.stream)
+
+    def emit(self, event, process=None, **fields):
+        record = {'ts': time.time(), 'event': event}
+        if process is not None:
+            record['process'] = process.id
+            record['pid'] = process.pid
+        record.update(fields)
+        self.put(record)
+
+    def put(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+
+        if not self.thread:
+            self.thread = threading.Thread(target=self._writer, name='event sink')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped}
+
+    def _writer(self):
+        import json
+
+        while 1:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            closing = batch[-1] is None
+            if closing:
+                batch.pop()
+
+            if self.dropped != self.reported_dropped:
+                batch.append({'ts': time.time(), 'event': 'events_dropped',
+                              'count': self.dropped - self.reported_dropped})
+                self.reported_dropped = self.dropped
+
+            try:
+                self.stream.write(''.join(json.dumps(x, default=repr) + '\n' for x in batch))
+                self.stream.flush()
+                self.written += len(batch)
+            except Exception as ex:
+                # the journal may be stdout, where this can't go
+                print('unexpected exception writing events: %s' % ex, file=sys.stderr)
+
+            if closing:
+                return
+
+    def close(self, timeout=2):
+        '''
+            writes what's queued, waiting at most timeout seconds
+        '''
+        if not self.thread:
+            return
+
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+        self.thread = None
+
+def EventLoggerListener(event, primo, process):
+    primo.event_sink.emit(event, process, latency=primo.dispatch_lag)
+
+def load_libc():
+    '''
+        the libc python is linked with, with errno. find_library would run
+        ldconfig
+    '''
+    import ctypes
+
+    return ctypes.CDLL(None, use_errno=True)
+
+def parse_cpu_list(s):
+    '''
+        >>> primo.parse_cpu_list('0-3,8,10-11')
+        [0, 1, 2, 3, 8, 10, 11]
+    '''
+    ret = set()
+    for part in s.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            ret.update(range(int(start), int(end) + 1))
+        else:
+            ret.add(int(part))
+    return sorted(ret)
+
+class CpuAllocator(object):
+    '''
+        Hands out CPUs to processes with <Placement cpus="auto"/>, round
+        robin over the NUMA nodes (and over the CPUs of each node), so
+        replicated workers are spread evenly over the sockets.
+    '''
+    def __init__(self):
+        available = set(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+                    else set(range(os.cpu_count() or 1))
+
+        self.nodes = []
+        for cpus in numa_nodes().values():
+            cpus = [x for x in cpus if x in available]
+            if cpus:
+                self.nodes.append(cpus)
+
+        if not self.nodes:
+            self.nodes = [sorted(available)]
+
+        self.next_node = 0
+        self.next_cpu = [0] * len(self.nodes)
+
+    def __repr__(self):
+        return '<CpuAllocator nodes=%s>' % self.nodes
+
+    def allocate(self, count=1):
+        # all CPUs of a process come from the same node
+        node = self.next_node
+        self.next_node = (self.next_node + 1) % len(self.nodes)
+
+        cpus = self.nodes[node]
+        ret = [cpus[(self.next_cpu[node] + i) % len(cpus)] for i in range(min(count, len(cpus)))]
+        self.next_cpu[node] = (self.next_cpu[node] + count) % len(cpus)
+        return ret
+
+def numa_nodes():
+    '''
+        node number -> list of cpus, empty if the NUMA topology is unknown
+    '''
+    ret = {}
+    base = '/sys/devices/system/node'
+    try:
+        names = os.listdir(base)
+    except OSError:
+        return ret
+
+    for name in names:
+        if name.startswith('node') and name[4:].isdigit():
+            try:
+                with open(os.path.join(base, name, 'cpulist')) as f:
+                    ret[int(name[4:])] = parse_cpu_list(f.read())
+            except (IOError, OSError, ValueError):
+                pass
+    return ret
+
+class Placement(object):
+    '''
+        Where and how a process runs: CPU affinity, nice, I/O class and
+        scheduling policy. Applied in the child, before exec. Values are
+        checked when the config is read, the child only makes the calls.
+    '''
+    IOCLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+    # ioprio_set has no Python binding
+    IOPRIO_SET_SYSCALL = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+                          'armv7l': 314, 'ppc64le': 273, 's390x': 282}
+
+    def __init__(self, cpus=None, nice=None, ioclass=None, iolevel=4, sched=None, priority=0):
+        self.cpus = cpus
+        self.nice = nice
+
+        self.ioprio = None
+        if ioclass:
+            if ioclass not in self.IOCLASSES:
+                raise Exception('Invalid ioclass: ', ioclass)
+            if not 0 <= iolevel <= 7:
+                raise Exception('Invalid iolevel: ', iolevel)
+            self.ioprio = (self.IOCLASSES[ioclass] << 13) | (0 if ioclass == 'idle' else iolevel)
+
+        self.sched = None
+        if sched:
+            policy = getattr(os, 'SCHED_' + sched.upper(), None)
+            if policy is None:
+                raise Exception('Invalid sched: ', sched)
+            # 1-99 for fifo and rr on Linux, 0 for the others
+            if not os.sched_get_priority_min(policy) <= priority <= os.sched_get_priority_max(policy):
+                raise Exception('Invalid priority for sched="%s": ' % sched, priority)
+            self.sched = (policy, priority)
+
+        self.ioclass = ioclass
+        self.sched_name = sched
+
+    def __repr__(self):
+        return '<Placement cpus=%s nice=%s ioclass=%s sched=%s>' % (self.cpus, self.nice, self.ioclass, self.sched_name)
+
+    def preexec_fn(self):
+        import ctypes
+
+        if sys.platform == 'win32':
+            return None
+
+        cpus, nice, ioprio, sched = self.cpus, self.nice, self.ioprio, self.sched
+
+        syscall = None
+        if ioprio is not None:
+            number = self.IOPRIO_SET_SYSCALL.get(os.uname().machine)
+            if number is None:
+                print('WARNING: ioclass is not supported on %s, I\'m *ignoring* it.' % os.uname().machine, file=sys.stderr)
+            else:
+                libc = load_libc()
+                # IOPRIO_WHO_PROCESS, 0 is the calling process
+                syscall = functools.partial(libc.syscall, number, 1, 0, ioprio)
+
+        def preexec():
+            if cpus and hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(0, cpus)
+            if sched:
+                os.sched_setscheduler(0, sched[0], os.sched_param(sched[1]))
+            if nice:
+                os.nice(nice)
+            if syscall and syscall() != 0:
+                raise OSError(ctypes.get_errno(), 'ioprio_set failed')
+
+        return preexec
+
+class ProcessPipe(object):
+    '''
+        OS pipe from a process stdout to another process stdin. primo keeps
+        both ends open, so either process can be restarted: the consumer
+        doesn't get an end of file when the producer finishes, and what the
+        producer wrote is still there for a restarted consumer.
+
+        With a tap, the data is copied to the tap file as well, using
+        splice(2) and sendfile(2) where available, so the bytes never go
+        through Python.
+    '''
+    def __init__(self, consumer_id, tap=None):
+        self.consumer_id = consumer_id
+        self.tap = tap
+
+        self.consumer_fd, consumer_w = os.pipe()
+        self.producer_fd = consumer_w
+
+        if tap:
+            # the producer writes to another pipe, moved to the consumer by _pump
+            tap_in, self.producer_fd = os.pipe()
+
+            # splice() doesn't take O_APPEND files
+            self.tap_fd = os.open(tap, os.O_WRONLY | os.O_CREAT, 0o644)
+            self.tap_offset = os.lseek(self.tap_fd, 0, os.SEEK_END)
+            self.tap_read_fd = os.open(tap, os.O_RDONLY)
+
+            t = threading.Thread(target=self._pump, args=(tap_in, consumer_w), name='tap %s' % consumer_id)
+            t.daemon = True
+            t.start()
+
+    def __repr__(self):
+        return '<ProcessPipe consumer=%s tap=%s>' % (self.consumer_id, self.tap)
+
+    def _pump(self, tap_in, consumer_w):
+        zero_copy = hasattr(os, 'splice') and hasattr(os, 'sendfile')
+
+        while 1:
+            if zero_copy:
+                try:
+                    # pipe -> tap file -> consumer pipe, all inside the kernel
+                    size = os.splice(tap_in, self.tap_fd, 65536)
+                except OSError:
+                    zero_copy = False
+                    continue
+
+                if not size:
+                    return
+
+                offset = self.tap_offset
+                self.tap_offset += size
+                while offset < self.tap_offset:
+                    offset += os.sendfile(consumer_w, self.tap_read_fd, offset, self.tap_offset - offset)
+            else:
+                data = os.read(tap_in, 65536)
+                if not data:
+                    return
+
+                os.write(self.tap_fd, data)
+                self.tap_offset += len(data)
+                while data:
+                    data = data[os.write(consumer_w, data):]
 
 class ScheduleCallbackInfo(object):
     def __init__(self, when, callback):
-        assert isinstance(when, float) # should be a timestamp like the returned by time.time()
+        assert isinstance(when, float) # should be a timestamp like the returned by time.monotonic()
         self.when = when
         self.callback = callback
 
@@ -172,7 +939,7 @@ class ScheduleCallbackInfo(object):
         return self.when >= x.when
 
     def __repr__(self):
-        t = time.localtime(self.when)
+        t = time.localtime(time.time() + self.when - time.monotonic())
         # showing "callback=<functools.partial object at 0x010596C0>" will not be of much help...
         func = self.callback if not isinstance(self.callback, functools.partial) \
                else '%s %s' % (self.callback.func, self.callback.args)
@@ -181,6 +948,8 @@ class ScheduleCallbackInfo(object):
         
 def warn_if_dying(meth):
     def new(*args, **kwargs):
+        import traceback
+
         if args[0].dying: # assuming args[0] is the self param
             print ('WARNING: Not supposed to happen when primo is dying.', \
                 'Callbacks scheduled when primo is dying will never be executed. Stack: \n"')
@@ -206,6 +975,50 @@ class PrimoStop(Exception):
     def __init__(self):
         pass
 
+class StartupProfile(object):
+    '''
+        Where primo startup time goes, from the first line of primo.py to
+        the first spawn, see --profile-startup. Each mark() closes a phase.
+    '''
+    def __init__(self, started):
+        self.started = started
+        self.last = started
+        self.phases = collections.OrderedDict()
+        self.added = 0
+        self.reported = False
+
+    def __repr__(self):
+        return '<StartupProfile phases=%s>' % dict(self.phases)
+
+    def add(self, phase, seconds):
+        '''
+            time spent in phase in the middle of another one
+        '''
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+        self.added += seconds
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + (now - self.last) - self.added
+        self.last = now
+        self.added = 0
+
+    def spawned(self):
+        if not self.reported:
+            self.mark('first spawn')
+            self.report()
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+
+        sys.stderr.write('startup profile (ms):\n')
+        for phase, seconds in self.phases.items():
+            sys.stderr.write('  %-14s %8.2f\n' % (phase, seconds * 1000))
+        sys.stderr.write('  %-14s %8.2f\n' % ('total', (self.last - self.started) * 1000))
+        sys.stderr.flush()
+
 class Primo(object):
     def __init__(self):
         self.processes = {}
@@ -214,6 +1027,43 @@ class Primo(object):
         self.global_listeners = []
         self.scheduling_log = False
         self.dying = False
+        self.state_journal = None
+
+        self.action_pool = None
+        self.action_timeout = None
+
+        # consumer process id -> ProcessPipe
+        self.pipes = {}
+
+        self.cpu_allocator = None
+
+        # Agent or Coordinator, when primo runs on several hosts
+        self.cluster = None
+        self.capacity = None
+
+        # TimerListeners, started by run()
+        self.timer_listeners = []
+
+        # StartupProfile, see --profile-startup
+        self.profile = None
+
+        self.event_sink = EventSink(sys.stdout)
+
+        # how late the callback being run by the main loop is
+        self.dispatch_lag = 0.0
+
+        # callbacks coming from other threads, see call_from_thread
+        self.loop_thread = None
+        self.thread_calls = collections.deque()
+        self.wakeup = threading.Event()
+
+        # file descriptors watched by the main loop, see add_reader
+        self.readers = {}
+        self.writers = {}
+        self.wakeup_r = None
+        self.wakeup_w = None
+        self.file_watcher = None
+
         self.initialize_global_listeners()
 
     def Stop(self):
@@ -229,7 +1079,158 @@ class Primo(object):
     def add_global_listener(self, listener):
         self.global_listeners.append(listener)
 
-    #@warn_if_dying    
+    def add_timer_listener(self, listener):
+        self.timer_listeners.append(listener)
+
+    def start_timer_listeners(self):
+        for listener in self.timer_listeners:
+            listener.start()
+
+    def setup_state_journal(self, path):
+        # the command line overrides the config file
+        if self.state_journal:
+            self.global_listeners.remove(self.state_journal)
+            for p in self.processes.values():
+                p.listeners.remove(self.state_journal)
+
+        self.state_journal = StateJournal(path)
+
+        self.add_global_listener(self.state_journal)
+        for p in self.processes.values():
+            p.add_listener(self.state_journal)
+
+    def setup_event_log(self, path):
+        self.event_sink.close()
+        self.event_sink = EventSink(sys.stdout if path == '-' else open(path, 'a'))
+
+    def setup_agent(self, address, capacity=None):
+        self.cluster = Agent(self, address, capacity)
+
+    def setup_coordinator(self, addresses, interval=2.0):
+        self.cluster = Coordinator(self, addresses, interval)
+
+    def model_hash(self):
+        '''
+            identifies the processes of the config, agents and their
+            coordinator must be running the same one
+        '''
+        import hashlib
+
+        model = sorted((id, p.config_hash()) for id, p in self.processes.items())
+        return hashlib.sha1(repr(model).encode('utf-8')).hexdigest()[:16]
+
+    def setup_action_pool(self, workers, timeout=None):
+        self.action_pool = ActionPool(self, workers)
+        self.action_timeout = timeout
+
+    def get_action_pool(self):
+        # async actions without <Primo actionWorkers="..."> get a default pool
+        if not self.action_pool:
+            self.action_pool = ActionPool(self, 4)
+        return self.action_pool
+
+    def call_from_thread(self, callback):
+        '''
+            the only thread safe way to get something done by primo: callback
+            will be called by the main loop
+        '''
+        self.thread_calls.append(callback)
+        self.wakeup.set()
+
+        if self.wakeup_w:
+            try:
+                self.wakeup_w.send(b'x')
+            except (BlockingIOError, OSError):
+                # full, the main loop will wake up anyway
+                pass
+
+    def _setup_wakeup(self):
+        import socket
+
+        if not self.wakeup_r:
+            # select() must be woken up by call_from_thread as well. A socket
+            # pair works on Windows too, where select() only takes sockets
+            self.wakeup_r, self.wakeup_w = socket.socketpair()
+            self.wakeup_r.setblocking(False)
+            self.wakeup_w.setblocking(False)
+
+    def add_reader(self, fd, callback):
+        '''
+            callback() is called by the main loop when fd is readable
+        '''
+        self._setup_wakeup()
+        self.readers[fd] = callback
+
+    def remove_reader(self, fd):
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fd, callback):
+        '''
+            callback() is called by the main loop when fd is writable
+        '''
+        self._setup_wakeup()
+        self.writers[fd] = callback
+
+    def remove_writer(self, fd):
+        self.writers.pop(fd, None)
+
+    def get_cpu_allocator(self):
+        if not self.cpu_allocator:
+            self.cpu_allocator = CpuAllocator()
+        return self.cpu_allocator
+
+    def get_pipe(self, consumer_id, tap=None):
+        # several producers may feed the same consumer, through the same tap
+        if consumer_id not in self.pipes:
+            self.pipes[consumer_id] = ProcessPipe(consumer_id, tap)
+        elif self.pipes[consumer_id].tap != tap:
+            raise Exception('Pipe to "%s" has tap "%s", not "%s"' % (consumer_id, self.pipes[consumer_id].tap, tap))
+        return self.pipes[consumer_id]
+
+    def get_file_watcher(self):
+        if not self.file_watcher:
+            self.file_watcher = FileWatcher(self)
+        return self.file_watcher
+
+    def _wait(self, timeout):
+        import select
+
+        if not self.readers and not self.writers:
+            self.wakeup.wait(timeout)
+            return
+
+        # something was handed over while we were busy
+        if self.wakeup.is_set():
+            return
+
+        readable, writable = select.select(list(self.readers) + [self.wakeup_r], list(self.writers), [], timeout)[:2]
+
+        for fd in readable:
+            if fd is self.wakeup_r:
+                try:
+                    while self.wakeup_r.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+
+            self._call_ready(self.readers, fd)
+
+        for fd in writable:
+            self._call_ready(self.writers, fd)
+
+    def _call_ready(self, callbacks, fd):
+        # removed by a former callback
+        callback = callbacks.get(fd)
+        if not callback:
+            return
+
+        try:
+            callback()
+        except Exception as ex:
+            self.event_sink.emit('main_loop_exception', callback=repr(callback), error=repr(ex))
+
+    #@warn_if_dying    
     def add_process(self, process):
         if process.id is None:
             process.id = process.bin + '_' + str(len(self.processes))
@@ -239,18 +1240,30 @@ class Primo(object):
         for c in self.global_listeners:
             process.add_listener(c)
 
-    def schedule_callback_timestamp(self, callback, timestamp):
-        info = ScheduleCallbackInfo(timestamp, callback)
+    #
+    # The schedule is kept in time.monotonic() time, so wall clock changes
+    # can't stall or burst the main loop. Wall clock timestamps are converted
+    # when scheduled.
+    #
+    def schedule_callback_monotonic(self, callback, when):
+        # actions running in the action pool call process.Start() and friends
+        if self.loop_thread and threading.get_ident() != self.loop_thread:
+            self.call_from_thread(functools.partial(self.schedule_callback_monotonic, callback, when))
+            return
+
+        info = ScheduleCallbackInfo(when, callback)
 
         if self.scheduling_log:
-            print (info)
+            print (info, file=sys.stderr)
             
         heappush(self.schedule, info)
         return id(info)
+
+    def schedule_callback_timestamp(self, callback, timestamp):
+        return self.schedule_callback_monotonic(callback, time.monotonic() + (timestamp - time.time()))
             
     def schedule_callback(self, callback, delay):
-        timestamp = time.time() + delay
-        return self.schedule_callback_timestamp(callback, timestamp)
+        return self.schedule_callback_monotonic(callback, time.monotonic() + delay)
         
     def post_global_event(self, event, delay = 0):
         return self.schedule_callback(
@@ -272,11 +1285,19 @@ class Primo(object):
             functools.partial(callback, event, self, process),
             timestamp)
 
+    def post_event_monotonic(self, event, process, callback, when):
+        return self.schedule_callback_monotonic(
+            functools.partial(callback, event, self, process),
+            when)
+
     def post_timer_event(self, process, callback, delay):
         return self.post_event('timer', process, callback, delay)
 
     def post_timer_event_timestamp(self, process, callback, timestamp):
         return self.post_event_timestamp('timer', process, callback, timestamp)    
+
+    def post_timer_event_monotonic(self, process, callback, when):
+        return self.post_event_monotonic('timer', process, callback, when)
         
     def raise_global_event(self, event, cancel_event = None):
         for p in self.processes.values():
@@ -298,54 +1319,90 @@ class Primo(object):
                         #
                         self.raise_process_event(cancel_event, self, c)
                     except Exception as ex:
-                        print('unexpected exception calling cancel listeners: %s' % ex)
+                        self.event_sink.emit('listener_exception', process, listener='cancel listeners', error=repr(ex))
                         
                     raise # reraise the exception after notifying the cancel
                 else:
-                    print ('callback "%s" is trying to cancel the event "%s", that can\'t be cancelled. Exception: %s' \
-                          % (c, event, ex))
+                    self.event_sink.emit('listener_exception', process, listener=repr(c), error=repr(ex),
+                                         reason='"%s" can\'t be cancelled' % event)
                 
                 
             except Exception as ex:
-                print ('unexpected exception from callback "%s": %s' % (c, ex))
+                self.event_sink.emit('listener_exception', process, listener=repr(c), error=repr(ex))
                 
             
     def run(self):
-        self.post_global_event('after_attach')
+        if self.profile:
+            self.profile.mark('setup')
+
+        for id in self.pipes:
+            if id not in self.processes:
+                self.event_sink.emit('warning', message='StdoutToProcess to unknown process "%s", the producer will block when the pipe is full' % id)
+            elif self.processes[id].stdin_src:
+                # stdin is the pipe, the file would never be read. Producers
+                # may come after their consumer, so it's checked here
+                raise Exception('Process "%s" has StdinFromFile, it can\'t be fed by StdoutToProcess' % id)
+
+        if not self.cluster:
+            self.start_timer_listeners()
+
+        if self.profile:
+            self.profile.mark('listeners')
+
+        if self.state_journal:
+            self.state_journal.adopt(self)
+
+        if self.cluster:
+            # the processes are attached when the coordinator says so
+            self.cluster.attach()
+        else:
+            self.post_global_event('after_attach')
 
         max_sleep = 5
         self.dying = False
+        self.loop_thread = threading.get_ident()
         
         #
         # main loop
         #
         while 1:
             try:
-                while self.schedule and self.schedule[0].when < time.time():
+                self.wakeup.clear()
+                while self.thread_calls:
+                    self.schedule_callback(self.thread_calls.popleft(), 0)
+
+                while self.schedule and self.schedule[0].when < time.monotonic():
                     c = heappop(self.schedule)
+                    self.dispatch_lag = time.monotonic() - c.when
                     try:
                         c.callback()
                     except PrimoStop as ex:
-                        print ('primo.Stop() called')
+                        self.event_sink.emit('stop')
                         self.dying = True
                         break
                     except Exception as ex:
-                        print ('exception on main loop: %s' % (repr(ex),))
+                        self.event_sink.emit('main_loop_exception', callback=repr(c), error=repr(ex),
+                                             latency=self.dispatch_lag)
+                    finally:
+                        self.dispatch_lag = 0.0
+
+                if self.dying:
+                    break
                     
                 if not self.schedule:
-                    time.sleep(max_sleep)
+                    self._wait(max_sleep)
                     continue
                 
-                time_to_next = self.schedule[0].when - time.time()
+                time_to_next = self.schedule[0].when - time.monotonic()
 
                 if time_to_next <= 0:
                     continue
 
                 time_to_next = min( (time_to_next, max_sleep) )
 
-                time.sleep(time_to_next)                
+                self._wait(time_to_next)
             except BaseException as ex:
-                print ('exception on main loop: %s' % (repr(ex),))
+                self.event_sink.emit('main_loop_exception', error=repr(ex))
                 self.dying = True
                 break
 
@@ -353,200 +1410,1433 @@ class Primo(object):
                 break
 
 
-        #
-        # MUST be a raise, we're already out of run loop
-        #
-        self.raise_global_event('before_detach')
+        #
+        # MUST be a raise, we're already out of run loop
+        #
+        if self.cluster:
+            self.cluster.detach()
+        else:
+            self.raise_global_event('before_detach')
+
+        if self.profile:
+            # nothing was spawned
+            self.profile.report()
+
+        if self.action_pool:
+            self.action_pool.shutdown()
+
+        self.event_sink.close()
+
+'''
+    Here for sake of history. You can do all this stuff using RunCodeOnEventListener
+
+def KillOnDetach(event, primo, process):
+    if event == 'before_detach':
+        process.KillNow()
+        
+def KeepRunningListener(event, primo, process):
+    if event == 'after_finish':
+        process.Start()
+
+def AutoStartListener(event, primo, process):
+    if event == 'after_attach':
+        process.Start()
+
+def LogEventsListener(event, primo, process):
+    print 'process "%s", event="%s"' % (process.bin, event)
+
+'''
+
+def FinishMonitorListener(event, primo, process):
+    if event in ('after_start', 'after_adopt'):
+        primo.post_timer_event(process, FinishMonitorListener, 1) 
+        return
+
+    elif event == 'timer':
+        if process.process_obj and not process.process_obj.poll() == None:
+            process.running = False
+            primo.raise_process_event('after_finish', process)
+            return
+
+        primo.post_timer_event(process, FinishMonitorListener, 1)
+
+class StringCodeAdapter(object):
+    def __init__(self, globals, string_code):
+        # it will complain about wrong identation if there are spaces in the beggining
+        string_code = string_code.strip(' \t')
+        
+        self.func = compile(string_code, '<string>', 'exec')
+        self.string_code = string_code
+        self.globals = globals
+        
+    def __call__(self, event, primo, process, **extra):
+        globals = {'event': event, 'primo' : primo, 'process' : process, 'ret' : None}
+        globals.update(extra)
+        if self.globals:
+            globals.update(self.globals)
+        exec(self.func, globals)
+        return globals['ret']
+
+    def __repr__(self):
+        return '<StringCodeAdapter string_code="%s">'% self.string_code
+
+class EmbeddedCodeAdapter(object):
+    def __init__(self, globals, string_code):
+       self.string_code = string_code.strip(' \t')
+       self.globals = globals
+        
+    def __call__(self, primo, process):
+        globals = {'primo' : primo, 'process' : process}
+        if self.globals:
+            globals.update(self.globals)
+
+        ret = ''
+
+        for x in SplitCodeSections(self.string_code):
+            if x[0] == '{':
+                ret += str(eval(x.strip('{}'), globals))
+            else:
+                ret += x
+
+        return ret                
+
+    def __repr__(self):
+        return '<StringCodeAdapter string_code="%s">'% self.string_code
+
+class ReadinessCheckAdapter(object):
+    '''
+        evaluates a python expression telling if the "candidate" instance
+        started by Process.Replace() is ready to take over
+    '''
+    def __init__(self, globals, string_code):
+        string_code = string_code.strip(' \t{}')
+
+        self.func = compile(string_code, '<string>', 'eval')
+        self.string_code = string_code
+        self.globals = globals
+
+    def __call__(self, primo, process, candidate):
+        globals = {'primo' : primo, 'process' : process, 'candidate' : candidate}
+        if self.globals:
+            globals.update(self.globals)
+        return eval(self.func, globals)
+
+    def __repr__(self):
+        return '<ReadinessCheckAdapter string_code="%s">'% self.string_code
+
+
+class ActionPool(object):
+    '''
+        Runs listener actions in worker threads, so a slow action doesn't
+        delay the timers and events of every other process. Results and
+        exceptions are reported by the main loop. stats() tells the queue
+        depth and the latency of each action.
+    '''
+    def __init__(self, primo, workers):
+        import concurrent.futures
+
+        self.primo = primo
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='primo_action')
+
+        # only touched by the main loop
+        self.pending = 0
+        self.actions = {}
+
+    def __repr__(self):
+        return '<ActionPool workers=%d pending=%d>' % (self.workers, self.pending)
+
+    def submit(self, func, event, primo, process, timeout=None, extra=None):
+        extra = extra or {}
+        self.pending += 1
+
+        future = self.executor.submit(self._run, func, event, primo, process, time.monotonic(), extra)
+        future.add_done_callback(
+            lambda f: self.primo.call_from_thread(functools.partial(self._done, func, f)))
+
+        if timeout:
+            self.primo.schedule_callback(functools.partial(self._check_timeout, func, future, timeout), timeout)
+
+        return future
+
+    def _run(self, func, event, primo, process, submitted, extra):
+        started = time.monotonic()
+        func(event, primo, process, **extra)
+        return started - submitted, time.monotonic() - started
+
+    def _stats_for(self, func):
+        name = repr(func)
+        if name not in self.actions:
+            self.actions[name] = {'count': 0, 'errors': 0, 'timeouts': 0,
+                                  'latency_total': 0.0, 'latency_max': 0.0, 'queue_wait_max': 0.0}
+        return self.actions[name]
+
+    def _done(self, func, future):
+        self.pending -= 1
+        stats = self._stats_for(func)
+
+        if future.cancelled():
+            return
+
+        ex = future.exception()
+        if ex:
+            stats['errors'] += 1
+            self.primo.event_sink.emit('action_exception', action=repr(func), error=repr(ex))
+            return
+
+        queue_wait, latency = future.result()
+        stats['count'] += 1
+        stats['latency_total'] += latency
+        stats['latency_max'] = max(stats['latency_max'], latency)
+        stats['queue_wait_max'] = max(stats['queue_wait_max'], queue_wait)
+
+    def _check_timeout(self, func, future, timeout):
+        if future.done():
+            return
+
+        self._stats_for(func)['timeouts'] += 1
+
+        # a running thread can't be stopped, but a queued action can be dropped
+        self.primo.event_sink.emit('action_timeout', action=repr(func), timeout=timeout,
+                                   cancelled=future.cancel())
+
+    def stats(self):
+        actions = {}
+        for name, stats in self.actions.items():
+            stats = dict(stats)
+            stats['latency_avg'] = stats['latency_total'] / stats['count'] if stats['count'] else None
+            del stats['latency_total']
+            actions[name] = stats
+
+        return {'workers': self.workers, 'queue_depth': self.pending, 'actions': actions}
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+class PooledActionAdapter(object):
+    '''
+        runs func in the action pool. "before" events are always run right
+        away, the action must be able to cancel them.
+    '''
+    def __init__(self, pool, func, timeout):
+        self.pool = pool
+        self.func = func
+        self.timeout = timeout
+
+    def __call__(self, event, primo, process, **extra):
+        if event.startswith('before_'):
+            return self.func(event, primo, process, **extra)
+
+        self.pool.submit(self.func, event, primo, process, self.timeout, extra)
+
+    def __repr__(self):
+        return '<PooledActionAdapter func=%s>' % self.func
+
+class ProcessMethodAdapter(object):
+    def __init__(self, process_method):
+        self.process_method = process_method
+        
+    def __call__(self, event, primo, process):
+        self.process_method(process)
+
+    def __repr__(self):
+        return '<ProcessMethodAdapter method="%s">'% self.process_method
+
+class RunCodeOnEventListener(object):
+    def __init__(self, event_filter, func):
+        self.func = func
+        if isinstance(event_filter, str):
+            self.event_filter = [str(event_filter)]
+        else:
+            self.event_filter = event_filter
+
+    def __call__(self, event, primo, process):
+        if not self.event_filter or event in self.event_filter:
+            return self.func(event, primo, process)
+
+    def __repr__(self):
+        return '<RunCodeOnEventListener filter="%s", code="%s">'% (self.event_filter, self.func)
+
+def next_time_of_day(t, after=None):
+    '''
+        next local datetime at time of day t, strictly after "after" (now if not set)
+    '''
+    import datetime
+
+    after = max(after, datetime.datetime.now()) if after else datetime.datetime.now()
+
+    d = datetime.datetime.combine(after.date(), t)
+    if d <= after:
+        d = datetime.datetime.combine(after.date() + datetime.timedelta(days=1), t)
+    return d
+
+def local_timestamp(d):
+    # mktime knows if DST is in effect for d (tm_isdst is -1 for naive datetimes)
+    return time.mktime(d.timetuple())
+
+class TimerListener(object):
+    '''
+        Listener driven by its own timers. It's built when the config is
+        read, so bad attributes and actions are reported then, and its timers
+        only run between start() and stop()
+    '''
+    # waits for a wall clock time are split in MAX_WAIT seconds steps
+    MAX_WAIT = 60.0
+
+    def __init__(self, primo, process):
+        self.primo = primo
+        self.process = process
+        self.started = False
+
+        # timers scheduled before stop() see it changed and do nothing
+        self.generation = 0
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        self._start()
+
+    def stop(self):
+        self.started = False
+        self.generation += 1
+
+    def _start(self):
+        pass
+
+    def _guard(self, callback):
+        generation = self.generation
+
+        def guarded(*args, **kwargs):
+            if self.generation == generation:
+                return callback(*args, **kwargs)
+
+        return guarded
+
+    def schedule_callback(self, callback, delay):
+        return self.primo.schedule_callback(self._guard(callback), delay)
+
+    def schedule_timestamp(self, callback, timestamp):
+        '''
+            callback() at a wall clock time. The timers are monotonic, so the
+            remaining time is checked again every MAX_WAIT seconds: when the
+            wall clock is changed, callback() is never run early and is run
+            at most MAX_WAIT seconds late
+        '''
+        def wait():
+            delay = min(timestamp - time.time(), self.MAX_WAIT)
+            self.schedule_callback(check, max(delay, 0.0))
+
+        def check():
+            # the wall clock went back, it's not time yet
+            if time.time() < timestamp - 0.5:
+                wait()
+                return
+            callback()
+
+        wait()
+
+class EachXSecondsListener(TimerListener):
+    '''
+        Fixed rate timer: ticks are anchored to the time it was created, so
+        the dispatch lag and the action runtime don't add up. Ticks missed
+        because primo was busy are dropped ("skip", the next tick keeps the
+        phase) or run back to back ("catchup").
+    '''
+    def __init__(self, globals, primo, process, interval, action, missed='skip'):
+        TimerListener.__init__(self, primo, process)
+        self.interval = float(interval)
+        self.action = action
+
+        if missed not in ('skip', 'catchup'):
+            raise Exception('Invalid missed value: ', missed)
+        self.missed = missed
+
+        action = action.strip(' {}')
+        self.code = StringCodeAdapter(globals, action)
+
+        self.next = None
+
+    def _start(self):
+        self.next = time.monotonic()
+        self._schedule()
+
+    def _schedule(self):
+        import math
+
+        self.next += self.interval
+
+        now = time.monotonic()
+        if self.next < now and self.missed == 'skip':
+            self.next += math.ceil((now - self.next) / self.interval) * self.interval
+
+        self.primo.post_timer_event_monotonic(self.process, self._guard(self), self.next)
+
+    def __call__(self, action, primo, process):
+        due = self.next
+        self._schedule()
+        primo.event_sink.emit('timer', process, listener='EachXSeconds', action=self.action,
+                              interval=self.interval, latency=time.monotonic() - due)
+        self.code('timer', primo, process)
+        
+        
+class RunningPeriodListener(TimerListener):
+    '''
+        Keeps the process running only between start and end. Besides the
+        check on creation, there are only two timers: the next start and the
+        next end of the period. It listens to the process as well: inside the
+        period, a process that finishes is started again and outside it, a
+        process started by someone else is killed.
+    '''
+    def __init__(self, globals, primo, process, start, end):
+        import datetime
+
+        TimerListener.__init__(self, primo, process)
+
+        self.period_start = datetime.datetime.strptime(start, '%H:%M:%S').time()
+        self.period_end = datetime.datetime.strptime(end, '%H:%M:%S').time()
+
+        self.next_start = None
+        self.next_end = None
+
+    def _start(self):
+        self.schedule_callback(self.OnCheck, 0)
+        self._schedule_start()
+        self._schedule_end()
+
+    def _schedule_start(self):
+        self.next_start = next_time_of_day(self.period_start, self.next_start)
+        self.schedule_timestamp(self.OnStart, local_timestamp(self.next_start))
+
+    def _schedule_end(self):
+        self.next_end = next_time_of_day(self.period_end, self.next_end)
+        self.schedule_timestamp(self.OnEnd, local_timestamp(self.next_end))
+
+    def _emit(self, action, reason):
+        self.primo.event_sink.emit('running_period', self.process, action=action, reason=reason,
+                                   start=str(self.period_start), end=str(self.period_end))
+
+    def inside_period(self):
+        import datetime
+
+        current_time = datetime.datetime.now().time()
+
+        if self.period_start < self.period_end:
+            return current_time >= self.period_start and current_time <= self.period_end
+        else:
+            return current_time >= self.period_start or current_time <= self.period_end
+
+    def OnStart(self):
+        self._schedule_start()
+
+        if not self.process.running:
+            self._emit('start', 'period started')
+            self.process.Start()
+
+    def OnEnd(self):
+        self._schedule_end()
+
+        if self.process.running:
+            self._emit('kill', 'period ended')
+            self.process.KillNow()
+
+    def OnCheck(self):
+        inside_period = self.inside_period()
+
+        if inside_period and not self.process.running:
+            self._emit('start', 'inside period')
+            self.process.Start()
+
+        if not inside_period and self.process.running:
+            self._emit('kill', 'outside period')
+            self.process.KillNow()
+
+    def __call__(self, event, primo, process):
+        if not self.started:
+            return
+
+        if event == 'after_finish' and not process.running and self.inside_period():
+            self._emit('start', 'finished inside period')
+            process.Start()
+
+        elif event in ('after_start', 'after_adopt') and process.running and not self.inside_period():
+            self._emit('kill', 'started outside period')
+            process.KillNow()
+        
+
+class OnSpecificTimeListener(TimerListener):
+    def __init__(self, globals, primo, process, time, action):
+        import datetime
+
+        TimerListener.__init__(self, primo, process)
+        self.time = datetime.datetime.strptime(time, '%H:%M:%S').time()
+        self.action = action
+
+        action = action.strip(' {}')
+        self.code = StringCodeAdapter(globals, action)
+
+        self.datetime = None
+
+    def _start(self):
+        self._schedule()
+
+    def _schedule(self):
+        #
+        # strictly after the last run, so a callback run a bit early (the
+        # wall clock was changed) doesn't run twice
+        #
+        self.datetime = next_time_of_day(self.time, self.datetime)
+
+        self.schedule_timestamp(self.OnTimer, local_timestamp(self.datetime))
+
+    def OnTimer(self):
+        self.primo.event_sink.emit('timer', self.process, listener='OnSpecificTime', action=self.action,
+                                   time=str(self.datetime),
+                                   latency=time.time() - local_timestamp(self.datetime))
+        self.code('timer', self.primo, self.process)
+        self._schedule()
+
+class CronExpression(object):
+    '''
+        "minute hour day-of-month month day-of-week", with *, ranges (1-5),
+        steps (*/15, 9-17/2), lists (1,15) and month/weekday names.
+        next_after() works on naive local datetimes, jumping whole months,
+        days and hours that can't match instead of testing every minute.
+    '''
+    ALIASES = {
+        '@yearly': '0 0 1 1 *',
+        '@annually': '0 0 1 1 *',
+        '@monthly': '0 0 1 * *',
+        '@weekly': '0 0 * * 0',
+        '@daily': '0 0 * * *',
+        '@midnight': '0 0 * * *',
+        '@hourly': '0 * * * *',
+    }
+
+    MONTH_NAMES = ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec']
+    WEEKDAY_NAMES = ['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat']
+
+    def __init__(self, expr):
+        self.expr = expr
+        fields = self.ALIASES.get(expr.strip(), expr).split()
+        if len(fields) != 5:
+            raise Exception('Invalid cron expression: ', expr)
+
+        self.minutes = self._parse_field(fields[0], 0, 59)
+        self.hours = self._parse_field(fields[1], 0, 23)
+        self.days = self._parse_field(fields[2], 1, 31)
+        self.months = self._parse_field(fields[3], 1, 12, self.MONTH_NAMES, 1)
+        # 7 is sunday as well
+        self.weekdays = sorted(set(x % 7 for x in self._parse_field(fields[4], 0, 7, self.WEEKDAY_NAMES, 0)))
+
+        # like vixie cron: when both are lists, a day matching any of them
+        # is fine, when one of them starts with * (*/2 included), a day
+        # must match both
+        self.day_or_weekday = not (fields[2].startswith('*') or fields[4].startswith('*'))
+
+    def __repr__(self):
+        return '<CronExpression "%s">' % self.expr
+
+    def _parse_field(self, field, lo, hi, names=None, first=0):
+        def value(x):
+            if names and x.lower() in names:
+                return names.index(x.lower()) + first
+            return int(x)
+
+        ret = set()
+        for part in field.split(','):
+            if '/' in part:
+                part, step = part.split('/', 1)
+                step = int(step)
+            else:
+                step = 1
+
+            if part == '*':
+                start, end = lo, hi
+            elif '-' in part:
+                start, end = [value(x) for x in part.split('-', 1)]
+            else:
+                start = value(part)
+                # "5/10" means from 5 to the end, 10 by 10
+                end = hi if step > 1 else start
+
+            if start < lo or end > hi or start > end or step < 1:
+                raise Exception('Invalid cron field: ', field)
+
+            ret.update(range(start, end + 1, step))
+
+        return sorted(ret)
+
+    def _day_matches(self, d):
+        day = d.day in self.days
+        weekday = (d.weekday() + 1) % 7 in self.weekdays
+
+        if self.day_or_weekday:
+            return day or weekday
+        return day and weekday
+
+    def next_after(self, d):
+        '''
+            first matching datetime strictly after d
+        '''
+        import bisect
+        import datetime
+
+        d = d.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+
+        # "30 2 31 2 *" (february 31st) never happens
+        limit = d.year + 8
+
+        while d.year <= limit:
+            if d.month not in self.months:
+                i = bisect.bisect_right(self.months, d.month)
+                if i < len(self.months):
+                    d = d.replace(month=self.months[i], day=1, hour=0, minute=0)
+                else:
+                    d = d.replace(year=d.year + 1, month=self.months[0], day=1, hour=0, minute=0)
+                continue
+
+            if not self._day_matches(d):
+                d = d.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+
+            if d.hour not in self.hours:
+                i = bisect.bisect_right(self.hours, d.hour)
+                if i < len(self.hours):
+                    d = d.replace(hour=self.hours[i], minute=0)
+                else:
+                    d = d.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+                continue
+
+            if d.minute not in self.minutes:
+                i = bisect.bisect_right(self.minutes, d.minute)
+                if i < len(self.minutes):
+                    d = d.replace(minute=self.minutes[i])
+                else:
+                    d = d.replace(minute=0) + datetime.timedelta(hours=1)
+                continue
+
+            return d
+
+        raise Exception('Cron expression never matches: ', self.expr)
+
+class OnCronListener(TimerListener):
+    '''
+        Runs action on every time matching a cron expression. There's a
+        single timer per listener, for the next matching time.
+
+        Times are local (wall clock) times: a time skipped by DST runs when
+        the clock jumps over it, a time repeated by DST runs once. Long waits
+        are split in MAX_WAIT seconds steps, so a wall clock change is noticed:
+        the action never runs early, and runs only once after the clock jumps
+        forward past several matching times.
+    '''
+    def __init__(self, globals, primo, process, expr, action):
+        TimerListener.__init__(self, primo, process)
+        self.cron = CronExpression(expr)
+        self.action = action
+
+        action = action.strip(' {}')
+        self.code = StringCodeAdapter(globals, action)
+
+        self.datetime = None
+        self.timestamp = None
+
+    def _start(self):
+        self._schedule()
+
+    def _schedule(self):
+        import datetime
+
+        now = datetime.datetime.now()
+        after = max(self.datetime, now) if self.datetime else now
+        last_timestamp = self.timestamp
+
+        while 1:
+            self.datetime = self.cron.next_after(after)
+            self.timestamp = local_timestamp(self.datetime)
+
+            # leaving DST, mktime may map a repeated time before the last run
+            if last_timestamp is None or self.timestamp > last_timestamp:
+                break
+            after = self.datetime
+
+        self.schedule_timestamp(self._OnTimer, self.timestamp)
+
+    def _OnTimer(self):
+        self.primo.event_sink.emit('timer', self.process, listener='OnCron', action=self.action,
+                                   expr=self.cron.expr, time=str(self.datetime),
+                                   latency=time.time() - self.timestamp)
+        self._schedule()
+        self.code('timer', self.primo, self.process)
+
+class FileWatcher(object):
+    '''
+        Linux inotify, through ctypes. A single inotify file descriptor for
+        all OnFileChange listeners, read by primo main loop. A file is watched
+        through its directory, so a file replaced by a rename (the usual way
+        to deploy a binary) is seen as well.
+    '''
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_NONBLOCK = 0x800
+    IN_CLOEXEC = 0x80000
+
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+           IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+    # struct inotify_event, without the name
+    EVENT_HEADER = 'iIII'
+
+    # how often a watch lost with its directory is added again
+    RETRY_INTERVAL = 1.0
+
+    def __init__(self, primo):
+        self.primo = primo
+        self.fd = None
+        self.libc = None
+        # wd -> list of (name or None for the whole directory, path, callback)
+        self.watches = {}
+
+        if not sys.platform.startswith('linux'):
+            return
+
+        try:
+            self.libc = load_libc()
+            fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+
+        if fd < 0:
+            return
+
+        self.fd = fd
+        primo.add_reader(fd, self._read)
+
+    def __repr__(self):
+        return '<FileWatcher fd=%s watches=%d>' % (self.fd, len(self.watches))
+
+    def watch(self, path, callback):
+        '''
+            callback(changed_path) is called on every change. Returns False if
+            inotify can't be used, the caller must poll.
+        '''
+        if self.fd is None:
+            return False
+
+        path = os.path.abspath(path)
+        name = None if os.path.isdir(path) else os.path.basename(path)
+
+        return self._add(name, path, callback)
+
+    def _add(self, name, path, callback):
+        directory = path if name is None else os.path.dirname(path)
+
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(sys.getfilesystemencoding()), self.MASK)
+        if wd < 0:
+            return False
+
+        self.watches.setdefault(wd, []).append((name, path, callback))
+        return True
+
+    def _lost(self, wd):
+        '''
+            the watched directory was removed or renamed (a deploy replacing
+            it, for instance): everybody is notified and the watches are added
+            again, on whatever has the same path now
+        '''
+        watches = self.watches.pop(wd, None)
+        if not watches:
+            return
+
+        # a renamed directory would still be watched under its new name
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+        for name, path, callback in watches:
+            callback(path)
+
+        self._retry(watches, notify=False)
+
+    def _retry(self, watches, notify=True):
+        missing = []
+        for watch in watches:
+            if not self._add(*watch):
+                missing.append(watch)
+            elif notify:
+                # what changed while it wasn't watched
+                watch[2](watch[1])
+
+        if missing:
+            self.primo.schedule_callback(functools.partial(self._retry, missing), self.RETRY_INTERVAL)
+
+    def _read(self):
+        import struct
+
+        header_size = struct.calcsize(self.EVENT_HEADER)
+
+        while 1:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, size = struct.unpack_from(self.EVENT_HEADER, data, pos)
+                pos += header_size
+                name = data[pos:pos + size].rstrip(b'\0').decode(sys.getfilesystemencoding())
+                pos += size
+
+                if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF | self.IN_IGNORED):
+                    self._lost(wd)
+                    continue
+
+                if mask & self.IN_Q_OVERFLOW:
+                    # events lost, everybody is notified
+                    for watches in self.watches.values():
+                        for watch_name, path, callback in watches:
+                            callback(path)
+                    continue
+
+                for watch_name, path, callback in self.watches.get(wd, ()):
+                    if watch_name is None:
+                        callback(os.path.join(path, name) if name else path)
+                    elif watch_name == name:
+                        callback(path)
+
+class OnFileChangeListener(TimerListener):
+    '''
+        Runs action when a file, or anything in a directory, changes. Changes
+        are coalesced: the action runs once, "debounce" seconds after the last
+        change of a burst, with the changed paths in "changes". Uses inotify,
+        or polls each "poll_interval" seconds where it's not available.
+    '''
+    def __init__(self, globals, primo, process, path, action, debounce='0.5', pollInterval='2'):
+        TimerListener.__init__(self, primo, process)
+        self.path = path
+        self.action = action
+        self.debounce = float(debounce)
+        self.poll_interval = float(pollInterval)
+
+        action = action.strip(' {}')
+        self.code = StringCodeAdapter(globals, action)
+
+        self.changes = set()
+        self.deadline = None
+        self.snapshot = None
+        self.watched = False
+
+    def _start(self):
+        self.changes = set()
+        self.deadline = None
+
+        if self.watched:
+            return
+
+        if self.primo.get_file_watcher().watch(self.path, self.notify):
+            # inotify watches stay, notify() ignores them while stopped
+            self.watched = True
+        else:
+            self.snapshot = self._snapshot()
+            self.schedule_callback(self._poll, self.poll_interval)
+
+    def notify(self, path):
+        if not self.started:
+            return
+
+        self.changes.add(path)
+
+        pending = self.deadline is not None
+        self.deadline = time.monotonic() + self.debounce
+
+        # a single timer for the whole burst, it's pushed back on each change
+        if not pending:
+            self.schedule_callback(self._OnDebounce, self.debounce)
+
+    def _OnDebounce(self):
+        remaining = self.deadline - time.monotonic()
+        if remaining > 0:
+            self.schedule_callback(self._OnDebounce, remaining)
+            return
+
+        changes = sorted(self.changes)
+        self.changes = set()
+        self.deadline = None
+
+        self.primo.event_sink.emit('file_changed', self.process, listener='OnFileChange', action=self.action,
+                                   path=self.path, changes=changes)
+        self.code('file_changed', self.primo, self.process, changes=changes)
+
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino, st.st_mode)
+
+    def _snapshot(self):
+        ret = {self.path: self._stat(self.path)}
+        if os.path.isdir(self.path):
+            try:
+                names = os.listdir(self.path)
+            except OSError:
+                names = []
+            for name in names:
+                path = os.path.join(self.path, name)
+                ret[path] = self._stat(path)
+        return ret
+
+    def _poll(self):
+        self.schedule_callback(self._poll, self.poll_interval)
+
+        snapshot = self._snapshot()
+        for path in set(snapshot) | set(self.snapshot):
+            if snapshot.get(path) != self.snapshot.get(path):
+                self.notify(path)
+        self.snapshot = snapshot
+
+#
+# Multi-node supervision: an agent exposes the processes of its primo on a
+# socket, a coordinator runs the same config over several agents. The
+# protocol is one json object per line, each request gets one response:
+#
+#   {"id": 1, "op": "start", "process": "worker_1"}
+#   {"id": 1, "ok": true}
+#
+def parse_address(s):
+    '''
+        "host:port" for TCP, "unix:/path" (or just a path) for a Unix socket
+    '''
+    import socket
+
+    if s.startswith('unix:'):
+        return socket.AF_UNIX, s[5:]
+    if '/' in s or ':' not in s:
+        return socket.AF_UNIX, s
+
+    host, port = s.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+class Agent(object):
+    '''
+        Runs the processes a coordinator assigns to it. Processes not
+        assigned are disabled and don't get "after_attach", assigning one
+        attaches it (AutoStart and friends start it) and starts its timer
+        listeners, unassigning it raises "before_detach", stops its timer
+        listeners and kills it. Timer listeners outside a Process run on
+        every agent.
+    '''
+    MAX_EVENTS = 1000
+
+    # responses not read by a coordinator, the connection is closed past that
+    MAX_OUTPUT = 16 * 1024 * 1024
+
+    def __init__(self, primo, address, capacity=None):
+        self.primo = primo
+        self.address = address
+        self.capacity = capacity or primo.capacity or os.cpu_count() or 1
+
+        self.attached = set()
+        self.sock = None
+
+        # connection -> bytes received without a new line yet
+        self.buffers = {}
 
-'''
-    Here for sake of history. You can do all this stuff using RunCodeOnEventListener
+        # connection -> responses not sent yet
+        self.outputs = {}
 
-def KillOnDetach(event, primo, process):
-    if event == 'before_detach':
-        process.KillNow()
-        
-def KeepRunningListener(event, primo, process):
-    if event == 'after_finish':
-        process.Start()
+        # ring buffer of the process events, read by the coordinator
+        self.events = collections.deque(maxlen=self.MAX_EVENTS)
+        self.seq = 0
 
-def AutoStartListener(event, primo, process):
-    if event == 'after_attach':
-        process.Start()
+        self.ops = {
+            'hello': self._hello,
+            'status': self._status,
+            'assign': self._assign,
+            'events': self._events,
+            'start': lambda request: self._process(request).Start(),
+            'kill': lambda request: self._process(request).Kill(),
+            'replace': lambda request: self._process(request).Replace(),
+            'stop': lambda request: self.primo.Stop(),
+        }
 
-def LogEventsListener(event, primo, process):
-    print 'process "%s", event="%s"' % (process.bin, event)
+    def __repr__(self):
+        return '<Agent address=%s capacity=%s attached=%s>' % (self.address, self.capacity, sorted(self.attached))
+
+    def attach(self):
+        import socket
+
+        for p in self.primo.processes.values():
+            p.disabled = True
+            p.add_listener(self.record)
+
+        for listener in self.primo.timer_listeners:
+            if listener.process is None:
+                listener.start()
+
+        family, address = parse_address(self.address)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            # left by a former agent
+            os.unlink(address)
+
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+
+        self.primo.add_reader(self.sock, self._accept)
+        self.primo.event_sink.emit('agent_listening', address=self.address, capacity=self.capacity)
+
+    def detach(self):
+        import socket
+
+        for id in sorted(self.attached):
+            self.primo.raise_process_event('before_detach', self.primo.processes[id])
+
+        for listener in self.primo.timer_listeners:
+            listener.stop()
+
+        for conn in list(self.buffers):
+            self._close(conn)
+
+        if self.sock:
+            self.primo.remove_reader(self.sock)
+            self.sock.close()
+            family, address = parse_address(self.address)
+            if family == socket.AF_UNIX and os.path.exists(address):
+                os.unlink(address)
+
+    def record(self, event, primo, process):
+        self.seq += 1
+        self.events.append({'seq': self.seq, 'ts': time.time(), 'event': event,
+                            'process': process.id, 'pid': process.pid})
+
+    def _accept(self):
+        try:
+            conn = self.sock.accept()[0]
+        except (BlockingIOError, InterruptedError):
+            return
 
-'''
+        # a coordinator that doesn't read its responses mustn't block primo
+        conn.setblocking(False)
+        self.buffers[conn] = b''
+        self.outputs[conn] = bytearray()
+        self.primo.add_reader(conn, functools.partial(self._read, conn))
+
+    def _close(self, conn):
+        self.primo.remove_reader(conn)
+        self.primo.remove_writer(conn)
+        self.buffers.pop(conn, None)
+        self.outputs.pop(conn, None)
+        conn.close()
+
+    def _send(self, conn, data):
+        output = self.outputs[conn]
+        output += data
+
+        if len(output) > self.MAX_OUTPUT:
+            self._close(conn)
+            return
 
-def FinishMonitorListener(event, primo, process):
-    if event == 'after_start':
-        primo.post_timer_event(process, FinishMonitorListener, 1) 
-        return
+        self._write(conn)
 
-    elif event == 'timer':
-        if process.process_obj and not process.process_obj.poll() == None:
-            process.running = False
-            primo.raise_process_event('after_finish', process)
+    def _write(self, conn):
+        output = self.outputs.get(conn)
+        if output is None:
             return
 
-        primo.post_timer_event(process, FinishMonitorListener, 1)
+        try:
+            sent = conn.send(output)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._close(conn)
+            return
 
-class StringCodeAdapter(object):
-    def __init__(self, globals, string_code):
-        # it will complain about wrong identation if there are spaces in the beggining
-        string_code = string_code.strip(' \t')
-        
-        self.func = compile(string_code, '<string>', 'exec')
-        self.string_code = string_code
-        self.globals = globals
-        
-    def __call__(self, event, primo, process):
-        globals = {'event': event, 'primo' : primo, 'process' : process, 'ret' : None}
-        if self.globals:
-            globals.update(self.globals)
-        exec(self.func, globals)
-        return globals['ret']
+        del output[:sent]
 
-    def __repr__(self):
-        return '<StringCodeAdapter string_code="%s">'% self.string_code
+        if output:
+            self.primo.add_writer(conn, functools.partial(self._write, conn))
+        else:
+            self.primo.remove_writer(conn)
 
-class EmbeddedCodeAdapter(object):
-    def __init__(self, globals, string_code):
-       self.string_code = string_code.strip(' \t')
-       self.globals = globals
-        
-    def __call__(self, primo, process):
-        globals = {'primo' : primo, 'process' : process}
-        if self.globals:
-            globals.update(self.globals)
+    def _read(self, conn):
+        import json
 
-        ret = ''
+        try:
+            data = conn.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
 
-        for x in SplitCodeSections(self.string_code):
-            if x[0] == '{':
-                ret += str(eval(x.strip('{}'), globals))
-            else:
-                ret += x
+        if not data:
+            self._close(conn)
+            return
 
-        return ret                
+        lines = (self.buffers[conn] + data).split(b'\n')
+        self.buffers[conn] = lines.pop()
+
+        for line in lines:
+            if not line.strip():
+                continue
+
+            response = self.handle(line)
+            self._send(conn, (json.dumps(response, default=repr) + '\n').encode('utf-8'))
+
+            # closed by _send
+            if conn not in self.outputs:
+                return
+
+    def handle(self, line):
+        import json
+
+        request = {}
+        try:
+            request = json.loads(line)
+            op = self.ops.get(request.get('op'))
+            if not op:
+                raise Exception('unknown op: %s' % request.get('op'))
+
+            response = op(request)
+            if not isinstance(response, dict):
+                response = {}
+            response['ok'] = True
+        except Exception as ex:
+            response = {'ok': False, 'error': str(ex)}
+
+        response['id'] = request.get('id') if isinstance(request, dict) else None
+        return response
+
+    def _process(self, request):
+        id = request.get('process')
+        if id not in self.attached:
+            raise Exception('process "%s" is not attached here' % id)
+        return self.primo.processes[id]
+
+    def _hello(self, request):
+        return {'model': self.primo.model_hash(), 'capacity': self.capacity,
+                'attached': sorted(self.attached), 'seq': self.seq}
+
+    def _status(self, request):
+        processes = {}
+        for id, p in self.primo.processes.items():
+            processes[id] = {'running': p.running, 'pid': p.pid, 'attached': id in self.attached}
+        return {'capacity': self.capacity, 'processes': processes}
+
+    def _assign(self, request):
+        assigned = set(request.get('processes', []))
+
+        unknown = assigned - set(self.primo.processes)
+        if unknown:
+            raise Exception('unknown processes: %s' % ', '.join(sorted(unknown)))
+
+        for id in sorted(self.attached - assigned):
+            p = self.primo.processes[id]
+            self.attached.discard(id)
+            p.disabled = True
+            self.primo.raise_process_event('before_detach', p)
+            for listener in self._timer_listeners(p):
+                listener.stop()
+            p.KillNow()
+
+        for id in sorted(assigned - self.attached):
+            p = self.primo.processes[id]
+            self.attached.add(id)
+            p.disabled = False
+            for listener in self._timer_listeners(p):
+                listener.start()
+            self.primo.post_process_event('after_attach', p)
+
+        return {'attached': sorted(self.attached)}
+
+    def _timer_listeners(self, process):
+        return [x for x in self.primo.timer_listeners if x.process is process]
+
+    def _events(self, request):
+        since = request.get('since', 0)
+
+        # the agent was restarted, the coordinator has an old seq
+        if since > self.seq:
+            since = 0
+
+        lost = bool(self.events) and self.events[0]['seq'] > since + 1
+        return {'events': [x for x in self.events if x['seq'] > since], 'seq': self.seq, 'lost': lost}
+
+class AgentClient(object):
+    '''
+        Connection from a coordinator to an agent, not thread safe
+    '''
+    def __init__(self, address, timeout=5):
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+        self.file = None
+        self.next_id = 0
 
     def __repr__(self):
-        return '<StringCodeAdapter string_code="%s">'% self.string_code
+        return '<AgentClient address=%s>' % self.address
+
+    def close(self):
+        if self.sock:
+            self.file.close()
+            self.sock.close()
+        self.sock = None
+        self.file = None
+
+    def call(self, op, **args):
+        import json
+        import socket
+
+        if not self.sock:
+            family, address = parse_address(self.address)
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+            self.sock = sock
+            self.file = sock.makefile('rb')
+
+        self.next_id += 1
+        args['op'] = op
+        args['id'] = self.next_id
+
+        try:
+            self.sock.sendall((json.dumps(args) + '\n').encode('utf-8'))
+            line = self.file.readline()
+        except OSError:
+            self.close()
+            raise
+
+        if not line:
+            self.close()
+            raise IOError('connection closed by %s' % self.address)
+
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise Exception('%s: %s' % (self.address, response.get('error')))
+        return response
+
+class Coordinator(object):
+    '''
+        Runs the processes of the config over several agents. Each process
+        is placed on one agent, by declared capacity, and stays there while
+        the agent is alive. The agents are polled every "interval" seconds,
+        their events are written to the coordinator event journal with an
+        "agent" field.
+    '''
+    def __init__(self, primo, addresses, interval=2.0, timeout=5):
+        import concurrent.futures
 
+        self.primo = primo
+        self.interval = interval
+        self.clients = collections.OrderedDict((x, AgentClient(x, timeout)) for x in addresses)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max(len(self.clients), 1), 'coordinator')
+        self.model = primo.model_hash()
 
-class ProcessMethodAdapter(object):
-    def __init__(self, process_method):
-        self.process_method = process_method
-        
-    def __call__(self, event, primo, process):
-        self.process_method(process)
+        # address -> last hello, for the agents alive and running our model
+        self.agents = {}
+        self.mismatched = set()
+
+        # process id -> agent address
+        self.placement = {}
+        self.unplaced = []
+
+        # address -> last event seq read
+        self.seqs = {}
 
     def __repr__(self):
-        return '<ProcessMethodAdapter method="%s">'% self.process_method
+        return '<Coordinator agents=%s>' % list(self.clients)
 
-class RunCodeOnEventListener(object):
-    def __init__(self, event_filter, func):
-        self.func = func
-        if isinstance(event_filter, str):
-            self.event_filter = [str(event_filter)]
-        else:
-            self.event_filter = event_filter
+    def attach(self):
+        # the processes only run on the agents
+        for p in self.primo.processes.values():
+            p.disabled = True
 
-    def __call__(self, event, primo, process):
-        if not self.event_filter or event in self.event_filter:
-            return self.func(event, primo, process)
+        self.primo.schedule_callback(self._OnTimer, 0)
 
-    def __repr__(self):
-        return '<RunCodeOnEventListener filter="%s", code="%s">'% (self.event_filter, self.func)
+    def detach(self):
+        self.pool.shutdown(wait=False)
+        for client in self.clients.values():
+            client.close()
 
-class EachXSecondsListener(object):
-    def __init__(self, globals, primo, process, interval, action):
-        self.primo = primo
-        self.process = process
-        self.interval = float(interval)
-        self.action = action
+    def _OnTimer(self):
+        try:
+            self.poll()
+        finally:
+            self.primo.schedule_callback(self._OnTimer, self.interval)
 
-        action = action.strip(' {}')
-        self.code = StringCodeAdapter(globals, action)
-        
-        self._schedule()
+    def call_all(self, requests):
+        '''
+            requests: address -> (op, args), sent in parallel. Returns
+            address -> response, or the exception raised
+        '''
+        futures = [(address, self.pool.submit(self.clients[address].call, op, **args))
+                   for address, (op, args) in requests.items()]
 
-    def _schedule(self):
-        self.primo.post_timer_event(self.process, self, self.interval)
+        ret = {}
+        for address, future in futures:
+            try:
+                ret[address] = future.result()
+            except Exception as ex:
+                ret[address] = ex
+        return ret
+
+    def _emit(self, event, **fields):
+        self.primo.event_sink.emit(event, **fields)
+
+    def poll(self):
+        agents = {}
+        for address, hello in self.call_all(dict((x, ('hello', {})) for x in self.clients)).items():
+            if isinstance(hello, Exception):
+                if address in self.agents:
+                    self._emit('agent_lost', agent=address, error=str(hello))
+                continue
+
+            if hello['model'] != self.model:
+                if address not in self.mismatched:
+                    self._emit('agent_model_mismatch', agent=address, model=hello['model'], expected=self.model)
+                    self.mismatched.add(address)
+                continue
+
+            self.mismatched.discard(address)
+            if address not in self.agents:
+                self._emit('agent_found', agent=address, capacity=hello['capacity'])
+            agents[address] = hello
+
+        self.agents = agents
+        self.place()
+
+        assign = {}
+        for address, hello in self.agents.items():
+            processes = sorted(id for id, x in self.placement.items() if x == address)
+            if processes != hello['attached']:
+                assign[address] = ('assign', {'processes': processes})
+
+        for address, response in self.call_all(assign).items():
+            if isinstance(response, Exception):
+                self._emit('agent_assign_failed', agent=address, error=str(response))
+
+        self._read_events()
+
+    def place(self):
+        '''
+            greedy: a process stays on its agent while the agent is alive and
+            not over capacity, the others go to the agent with the most room
+        '''
+        # a restarted coordinator learns where the processes are
+        for address, hello in sorted(self.agents.items()):
+            for id in hello['attached']:
+                if self.placement.get(id) not in self.agents:
+                    self.placement[id] = address
+
+        load = dict.fromkeys(self.agents, 0)
+        placement = {}
+        pending = []
+
+        for id in sorted(self.primo.processes):
+            address = self.placement.get(id)
+            if address in load and load[address] < self.agents[address]['capacity']:
+                placement[id] = address
+                load[address] += 1
+            else:
+                pending.append(id)
 
-    def __call__(self, action, primo, process):
-        print ('EachXSeconds, callback="%s", interval="%0.2f"' % (self.code, self.interval))
-        self._schedule()
-        self.code('timer', primo, process)
-        
-        
-class RunningPeriodListener(object):
-    def __init__(self, globals, primo, process, start, end):
-        self.primo = primo
-        self.process = process
+        unplaced = []
+        for id in pending:
+            free = [(self.agents[x]['capacity'] - load[x], x) for x in sorted(load)]
+            room, address = max(free, key=lambda x: x[0]) if free else (0, None)
+            if room <= 0:
+                unplaced.append(id)
+                continue
+            placement[id] = address
+            load[address] += 1
 
-        self.start = datetime.datetime.strptime(start, '%H:%M:%S').time()
-        self.end = datetime.datetime.strptime(end, '%H:%M:%S').time()
-        
-        self._schedule()
+        if unplaced != self.unplaced:
+            self._emit('processes_unplaced', processes=unplaced)
+        self.unplaced = unplaced
+        self.placement = placement
 
-    def _schedule(self):
-        self.primo.post_timer_event(self.process, self, 1)
+    def _read_events(self):
+        requests = dict((x, ('events', {'since': self.seqs.get(x, 0)})) for x in self.agents)
 
-    def __call__(self, action, primo, process):
-        current_time = datetime.datetime.now().time()
+        for address, response in self.call_all(requests).items():
+            if isinstance(response, Exception):
+                continue
 
-        if self.start < self.end:
-            inside_period = (current_time >= self.start and current_time <= self.end)
-        else:
-            inside_period = (current_time >= self.start or current_time <= self.end)
-            
+            if response['lost']:
+                self._emit('agent_events_lost', agent=address)
 
-        if inside_period and not self.process.running:
-            print('inside running period: ', self.start, self.end, current_time)
-            self.process.Start()
+            for record in response['events']:
+                record['agent'] = address
+                self.primo.event_sink.put(record)
 
-        if not inside_period and self.process.running:
-            print('outside running period: ', self.start, self.end, current_time)
-            self.process.KillNow()
-                    
-        self._schedule()
-        
+            self.seqs[address] = response['seq']
 
-class OnSpecificTimeListener(object):
-    def __init__(self, globals, primo, process, time, action):
-        self.primo = primo
-        self.process = process
-        self.time = datetime.datetime.strptime(time, '%H:%M:%S').time()
-        self.action = action
+    #
+    # commands, fanned out to all the agents
+    #
+    def status(self):
+        agents = {}
+        processes = dict((id, {'agent': None, 'running': False, 'pid': None}) for id in self.primo.processes)
 
-        action = action.strip(' {}')
-        self.code = StringCodeAdapter(globals, action)
-        
-        self._schedule()
+        for address, response in self.call_all(dict((x, ('status', {})) for x in self.clients)).items():
+            if isinstance(response, Exception):
+                agents[address] = {'error': str(response)}
+                continue
 
-    def _schedule(self):
-        d = datetime.datetime.now()
+            agents[address] = {'capacity': response['capacity'], 'attached': 0}
+            for id, state in response['processes'].items():
+                if state['attached']:
+                    processes[id] = {'agent': address, 'running': state['running'], 'pid': state['pid']}
+                    agents[address]['attached'] += 1
 
-        # should schedule today or tomorrow?
-        if self.time < d.time():
-            d += datetime.timedelta(days=1)
+        return {'agents': agents, 'processes': processes}
 
-        d = datetime.datetime.combine(d.date(), self.time)
-        self.datetime = d
+    def _process_op(self, op, process_id):
+        responses = self.call_all(dict((x, (op, {'process': process_id})) for x in self.clients))
+        for address, response in responses.items():
+            if not isinstance(response, Exception):
+                return {'agent': address}
+        raise Exception('process "%s" is not attached to any agent' % process_id)
 
-        self.primo.schedule_callback_timestamp(self, time.mktime(d.timetuple()))
+    def start(self, process_id):
+        return self._process_op('start', process_id)
 
-    def __call__(self):
-        print ('OnSpecificTime, callback="%s", datetime="%s"' % (self.code, self.datetime))
-        self.code('timer', self.primo, self.process)
+    def kill(self, process_id):
+        return self._process_op('kill', process_id)
 
-        #
-        # reschedule. We *assuming* this callback will never be called
-        # before the specified time
-        #
-        assert(datetime.datetime.now().time() > self.time)
-        self._schedule()
+    def replace(self, process_id):
+        return self._process_op('replace', process_id)
+
+    def stop(self):
+        return dict((address, str(x) if isinstance(x, Exception) else 'ok')
+                    for address, x in self.call_all(dict((x, ('stop', {})) for x in self.clients)).items())
+
+    def command(self, s):
+        '''
+            status, stop, start:ID, kill:ID or replace:ID
+        '''
+        op, _, arg = s.partition(':')
+        if op in ('status', 'stop'):
+            return getattr(self, op)()
+        if op in ('start', 'kill', 'replace') and arg:
+            return getattr(self, op)(arg)
+        raise Exception('Invalid command: ', s)
 
 test_xml = \
 r'''
@@ -562,6 +2852,32 @@ r'''
 </Primo>
 '''
 
+def load_object(name):
+    '''
+        >>> primo.load_object('os.path:join')
+        <function join at 0x...>
+    '''
+    import importlib
+
+    if ':' in name:
+        module, attr = name.split(':', 1)
+    else:
+        module, attr = name.rsplit('.', 1)
+
+    obj = importlib.import_module(module)
+    for x in attr.split('.'):
+        obj = getattr(obj, x)
+    return obj
+
+def entry_points(group):
+    import importlib.metadata
+
+    eps = importlib.metadata.entry_points()
+    if hasattr(eps, 'select'):
+        return eps.select(group=group)
+    # before python 3.10
+    return eps.get(group, [])
+
 def SplitCodeSections(s):
     '''
         >>> primo.SplitCodeSections('{lala} abc {123} wer  {xpto}')
@@ -587,14 +2903,21 @@ def SplitCodeSections(s):
             
             
 
-class XmlConfigParser(xml.sax.handler.ContentHandler):
-    def __init__(self, cmdline_params):
+class XmlConfigParser(object):
+    '''
+        Driven by expat, with SAX like handlers. xml.sax isn't used: its
+        expat reader imports urllib.request, which takes longer than the
+        rest of primo startup
+    '''
+    def __init__(self, cmdline_params, profile=None):
         self.element_handlers = {}
         self.element_handlers['Primo'] = self._PrimoElement
         self.element_handlers['GlobalListeners'] = self._GlobalListenersElement
         self.element_handlers['Process'] = self._ProcessElement
         self.element_handlers['OnEvent'] = self._OnEventElement
         self.element_handlers['OnSpecificTime'] = self._OnSpecificTimeElement
+        self.element_handlers['OnCron'] = self._OnCronElement
+        self.element_handlers['OnFileChange'] = self._OnFileChangeElement
         self.element_handlers['RunningPeriod'] = self._RunningPeriod
         self.element_handlers['EachXSeconds'] = self._OnEachXSecondsElement
         self.element_handlers['CommandLineAdd'] = self._CommandLineAddElement
@@ -602,7 +2925,10 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
         self.element_handlers['Parameters'] = self._ParametersElement
         self.element_handlers['StdinFromFile'] = self._StdinFromFile
         self.element_handlers['StdoutToFile'] = self._StdoutToFile
+        self.element_handlers['StdoutToProcess'] = self._StdoutToProcess
+        self.element_handlers['Placement'] = self._Placement
         self.element_handlers['PythonCode'] = self._PythonCode
+        self.element_handlers['ReadinessCheck'] = self._ReadinessCheck
 
         # this will be filled by globals created by code
         # in action and in PythonCode sections
@@ -615,8 +2941,7 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
         self.cmdline_params = cmdline_params
         
         self.listeners['EventLogger'] = \
-            lambda name, attrs: RunCodeOnEventListener(None,
-                StringCodeAdapter(self.globals, 'print \'process "%s", event="%s"\' % (process.bin, event)'))
+            lambda name, attrs: EventLoggerListener
 
         self.listeners['KillOnDetach'] = \
             lambda name, attrs: RunCodeOnEventListener('before_detach', ProcessMethodAdapter(Process.KillNow))
@@ -625,21 +2950,35 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
             lambda name, attrs: RunCodeOnEventListener('after_attach', ProcessMethodAdapter(Process.Start))
 
         class AutoRestart(object):
+            '''
+                a single timer chain per process, whatever the number of
+                "after_attach" (an agent attaches a process again each time
+                it's assigned), stopped by "before_detach"
+            '''
             def __init__(self,interval):
-                self.interval = interval
+                self.interval = float(interval)
+                # process -> token of its timer chain
+                self.chains = {}
 
             def __call__(self, event, primo, process):
-                self.process = process
-                self.primo = primo
-                self._schedule()
+                if event == 'before_detach':
+                    self.chains.pop(process, None)
+                    return
 
-            def _schedule(self):
-                self.primo.schedule_callback(self.OnTimer, self.interval)
+                if process in self.chains:
+                    return
+
+                token = self.chains[process] = object()
+                self._schedule(primo, process, token)
 
-            def OnTimer(self):
-                process = self.process
+            def _schedule(self, primo, process, token):
+                primo.schedule_callback(functools.partial(self.OnTimer, primo, process, token), self.interval)
+
+            def OnTimer(self, primo, process, token):
+                if self.chains.get(process) is not token:
+                    return
 
-                self._schedule()                
+                self._schedule(primo, process, token)
                 
                 if process.disabled or process.running:
                     return
@@ -648,11 +2987,19 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
                 
 
         self.listeners['AutoRestart'] = \
-            lambda name, attrs: RunCodeOnEventListener('after_attach', AutoRestart(attrs['interval'] if 'interval' in attrs else 1))
+            lambda name, attrs: RunCodeOnEventListener(['after_attach', 'before_detach'], AutoRestart(attrs['interval'] if 'interval' in attrs else 1))
+
+        self.listeners['Listener'] = \
+            lambda name, attrs: self._PluginListener(load_object(attrs['class']), attrs, ('class',))
+
+        # listeners registered by installed packages, loaded on the first
+        # element not known by primo
+        self.entry_points_loaded = False
         
         self.context_stack = []
 
         self.primo = None
+        self.profile = profile
 
     def _push_current_handler(self):
         self._push_handler(self.context_stack[-1].handler)
@@ -688,23 +3035,98 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
     def _PythonCode(self, name, attrs):
         pass
 
+    def _ReadinessCheck(self, name, attrs):
+        process = getattr(self.context_stack[-1], 'process', None)
+        assert process
+
+        # 'condition' is always code run on runtime, not on config read
+        if 'condition' in attrs:
+            process.readiness_check = ReadinessCheckAdapter(self.globals, attrs['condition'])
+        if 'interval' in attrs:
+            process.readiness_interval = float(self.EmbeddedCodeProcessor(attrs['interval']))
+        if 'timeout' in attrs:
+            process.readiness_timeout = float(self.EmbeddedCodeProcessor(attrs['timeout']))
+        if 'stopTimeout' in attrs:
+            process.stop_timeout = float(self.EmbeddedCodeProcessor(attrs['stopTimeout']))
+
     def _StdoutToFile(self, name, attrs):
         process = getattr(self.context_stack[-1], 'process', None)
         assert process
 
         path = self.EmbeddedCodeProcessor(attrs['path'])        
 
+        # stdout is a single file descriptor, it can't go to both
+        if process.stdout_pipe:
+            raise Exception('Process "%s" has StdoutToProcess already, it can\'t have StdoutToFile' % (process.id or process.bin))
+
         # TODO: check invalid modes
         if 'mode' in attrs and attrs['mode'] == 'append':
             mode = 'ab'
         else:
             mode = 'wb'
 
-        f = open(path, mode)
+        max_bytes = parse_size(self.EmbeddedCodeProcessor(attrs['maxBytes'])) if 'maxBytes' in attrs else None
+        keep = int(self.EmbeddedCodeProcessor(attrs['keep'])) if 'keep' in attrs else 5
+        compress = self.EmbeddedCodeProcessor(attrs['compress']) if 'compress' in attrs else None
+
+        f = RotatingFile(path, mode, max_bytes, keep, compress)
         process.setup_stdout(f)        
                 
         
+    def _StdoutToProcess(self, name, attrs):
+        process = getattr(self.context_stack[-1], 'process', None)
+        assert process
+
+        consumer_id = self.EmbeddedCodeProcessor(attrs['id'])
+        tap = self.EmbeddedCodeProcessor(attrs['tap']) if 'tap' in attrs else None
+
+        # stdout is a single file descriptor, it can't go to both
+        if process.stdout_dst:
+            raise Exception('Process "%s" has StdoutToFile already, it can\'t have StdoutToProcess' % (process.id or process.bin))
+
+        process.setup_stdout_pipe(self.primo.get_pipe(consumer_id, tap))
+
+    def _Placement(self, name, attrs):
+        process = getattr(self.context_stack[-1], 'process', None)
+        assert process
+
+        attrs2 = {}
+        for key, value in attrs.items():
+            attrs2[str(key)] = self.EmbeddedCodeProcessor(value)
+
+        cpus = None
+        if 'node' in attrs2:
+            nodes = numa_nodes()
+            if int(attrs2['node']) not in nodes:
+                raise Exception('Invalid NUMA node: ', attrs2['node'])
+            cpus = nodes[int(attrs2['node'])]
+        if attrs2.get('cpus') == 'auto':
+            cpus = self.primo.get_cpu_allocator().allocate(int(attrs2.get('count', 1)))
+        elif 'cpus' in attrs2:
+            cpus = parse_cpu_list(attrs2['cpus'])
+
+        process.placement = Placement(
+            cpus,
+            int(attrs2['nice']) if 'nice' in attrs2 else None,
+            attrs2.get('ioclass'),
+            int(attrs2.get('iolevel', 4)),
+            attrs2.get('sched'),
+            int(attrs2.get('priority', 0)))
+
     def _PrimoElement(self, name, attrs):
+        if 'eventLog' in attrs:
+            self.primo.setup_event_log(self.EmbeddedCodeProcessor(attrs['eventLog']))
+
+        if 'actionWorkers' in attrs:
+            timeout = float(self.EmbeddedCodeProcessor(attrs['actionTimeout'])) if 'actionTimeout' in attrs else None
+            self.primo.setup_action_pool(int(self.EmbeddedCodeProcessor(attrs['actionWorkers'])), timeout)
+
+        if 'stateJournal' in attrs:
+            self.primo.setup_state_journal(self.EmbeddedCodeProcessor(attrs['stateJournal']))
+
+        if 'capacity' in attrs:
+            self.primo.capacity = int(self.EmbeddedCodeProcessor(attrs['capacity']))
+
         self._push_current_handler()
 
     def _OnSpecificTimeElement(self, name, attrs):
@@ -713,13 +3135,41 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
         attrs2 = {}
         # 'action' is always code run on runtime, not on config read
         for key, value in attrs.items():
+            if key in self.POOL_ATTRIBUTES:
+                continue
             attrs2[str(key)] = self.EmbeddedCodeProcessor(value) if key != 'action' else value
             
-        return OnSpecificTimeListener(
+        self._TimerListener(attrs, OnSpecificTimeListener(
+            self.globals,
+            self.primo,
+            process,
+            **attrs2))
+
+    def _OnCronElement(self, name, attrs):
+        process = getattr(self.context_stack[-1], 'process', None)
+
+        self._TimerListener(attrs, OnCronListener(
+            self.globals,
+            self.primo,
+            process,
+            self.EmbeddedCodeProcessor(attrs['expr']),
+            attrs['action']))
+
+    def _OnFileChangeElement(self, name, attrs):
+        process = getattr(self.context_stack[-1], 'process', None)
+
+        attrs2 = {}
+        # 'action' is always code run on runtime, not on config read
+        for key, value in attrs.items():
+            if key in self.POOL_ATTRIBUTES:
+                continue
+            attrs2[str(key)] = self.EmbeddedCodeProcessor(value) if key != 'action' else value
+
+        self._TimerListener(attrs, OnFileChangeListener(
             self.globals,
             self.primo,
             process,
-            **attrs2)
+            **attrs2))
 
     def _RunningPeriod(self, name, attrs):
         process = getattr(self.context_stack[-1], 'process', None)
@@ -727,26 +3177,31 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
         start = self.EmbeddedCodeProcessor(attrs['start'])
         end = self.EmbeddedCodeProcessor(attrs['end'])
         
-        return RunningPeriodListener(
+        listener = RunningPeriodListener(
             self.globals,
             self.primo,
             process,
             start,
             end)
 
+        self.primo.add_timer_listener(listener)
+        process.add_listener(listener)
+
     def _OnEachXSecondsElement(self, name, attrs):
         process = getattr(self.context_stack[-1], 'process', None)
 
         attrs2 = {}
         # 'action' is always code run on runtime, not on config read
         for key, value in attrs.items():
+            if key in self.POOL_ATTRIBUTES:
+                continue
             attrs2[str(key)] = self.EmbeddedCodeProcessor(value) if key != 'action' else value
             
-        return EachXSecondsListener(
+        self._TimerListener(attrs, EachXSecondsListener(
             self.globals,
             self.primo,
             process,
-            **attrs2)
+            **attrs2))
 
     def _ParametersElement(self, name, attrs):
         def add_parameter(name, attrs):
@@ -793,6 +3248,9 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
         self._push_handler(add_parameter)
 
     def EmbeddedCodeProcessor(self, s):
+        if self.profile:
+            started = time.perf_counter()
+
         eval_globals = {}
         eval_globals['primo'] = self.primo
         eval_globals['process'] = getattr(self.context_stack[-1], 'process', None)
@@ -806,6 +3264,9 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
             else:
                 ret += x
 
+        if self.profile:
+            self.profile.add('expressions', time.perf_counter() - started)
+
         return ret                
 
     def _CommandLineAddElement(self, name, attrs):
@@ -824,14 +3285,72 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
         event = attrs['event']
         action = attrs['action']
         action = action.strip('{}')
-        return RunCodeOnEventListener(event, StringCodeAdapter(self.globals, action))
+        return RunCodeOnEventListener(event, self._Pooled(attrs, StringCodeAdapter(self.globals, action)))
+
+    POOL_ATTRIBUTES = ('async', 'timeout')
+
+    def _Pooled(self, attrs, code):
+        '''
+            actions run in the action pool if async="true", or by default
+            if there's a <Primo actionWorkers="N">
+        '''
+        if 'async' in attrs:
+            pooled = self.EmbeddedCodeProcessor(attrs['async']).lower() == 'true'
+        else:
+            pooled = self.primo.action_pool is not None
+
+        if not pooled:
+            return code
+
+        if 'timeout' in attrs:
+            timeout = float(self.EmbeddedCodeProcessor(attrs['timeout']))
+        else:
+            timeout = self.primo.action_timeout
+
+        return PooledActionAdapter(self.primo.get_action_pool(), code, timeout)
+
+    def _TimerListener(self, attrs, listener):
+        '''
+            the listener is checked now, its timers start with primo
+        '''
+        listener.code = self._Pooled(attrs, listener.code)
+        self.primo.add_timer_listener(listener)
         
 
+    def _PluginListener(self, cls, attrs, exclude=()):
+        '''
+            python classes as listeners. The attributes are evaluated once, on
+            config read, and passed as keyword arguments to the constructor
+        '''
+        kwargs = {}
+        for key, value in attrs.items():
+            if key in exclude or key in self.POOL_ATTRIBUTES:
+                continue
+            kwargs[str(key)] = self.EmbeddedCodeProcessor(value)
+
+        return self._Pooled(attrs, cls(**kwargs))
+
+    ENTRY_POINT_GROUP = 'primo.listeners'
+
+    def _DiscoverListener(self, name):
+        if not self.entry_points_loaded:
+            self.entry_points_loaded = True
+
+            for ep in entry_points(self.ENTRY_POINT_GROUP):
+                if ep.name not in self.listeners:
+                    self.listeners[ep.name] = \
+                        lambda name, attrs, ep=ep: self._PluginListener(ep.load(), attrs)
+
+        return name in self.listeners
+
     def _GlobalListenersElement(self, name, attrs):
         def add_global_listener(name, attrs):
             if name == 'OnEvent':
                 listener = self._OnEventElement(name, attrs)
             else:
+                # entry points are only looked up for unknown names, it's slow
+                if name not in self.listeners:
+                    self._DiscoverListener(name)
                 listener = self.listeners[name](name, attrs)
                 
             self.primo.add_global_listener(listener)
@@ -851,7 +3370,8 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
             if name == 'OnEvent':
                 listener = self._OnEventElement(name, attrs)
             else:
-                if name in self.listeners:
+                if name in self.listeners or \
+                   (name not in self.element_handlers and self._DiscoverListener(name)):
                     listener = self.listeners[name](name, attrs)
                 else:
                     listener = None
@@ -866,20 +3386,38 @@ class XmlConfigParser(xml.sax.handler.ContentHandler):
     def _SimpleElementRouter(self, name, attrs):
         self.element_handlers[name](name, attrs)
 
+    def _expat(self):
+        started = time.perf_counter()
+        import xml.parsers.expat
+
+        if self.profile:
+            self.profile.add('imports', time.perf_counter() - started)
+
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        parser.CharacterDataHandler = self.characters
+
+        self.startDocument()
+        return parser
+
     def parse_file(self, file_name):
-        xml.sax.parse(file_name, self)
+        parser = self._expat()
+        with open(file_name, 'rb') as f:
+            parser.ParseFile(f)
         return self.primo        
 
     def parse_string(self, string):
-        xml.sax.parseString(string, self)
+        self._expat().Parse(string, True)
         return self.primo
 
     #
-    # SAX handlers
+    # SAX like handlers
     #
 
     def startDocument(self):
         self.primo = Primo()
+        self.primo.profile = self.profile
         self._push_handler(self._SimpleElementRouter)
 
     def endElement(self, name):
@@ -931,9 +3469,7 @@ def Test():
             ProcessMethodAdapter(Process.Start)))
 
     # log all events
-    primo.add_global_listener(
-        RunCodeOnEventListener(None,
-            StringCodeAdapter(globals(), 'print \'process "%s", event="%s"\' % (process.bin, event)')))
+    primo.add_global_listener(EventLoggerListener)
 
     # kill on detach
     primo.add_global_listener(
@@ -948,24 +3484,55 @@ def Test():
     primo.run()
 
 def SetupCommandLine():
+    from optparse import OptionParser
+
     parser = OptionParser()
 
     parser.add_option('-d', "--debug", dest="debug", action='store_true', default=False)
 
     parser.add_option("--parameter", dest="parameters", action='append',
                       help="parameter whose value can be retrivied inside the config file using the ParameterFromCommandLine tag")
+
+    parser.add_option("--event-log", dest="event_log",
+                      help="file where events are written as json lines, - for stdout (the default)")
+
+    parser.add_option("--state-journal", dest="state_journal",
+                      help="journal file used to adopt the processes left running by a former primo instance")
+
+    parser.add_option("--agent", dest="agent",
+                      help="runs as an agent listening on host:port or unix:/path, processes run when a coordinator assigns them")
+
+    parser.add_option("--capacity", dest="capacity", type="int",
+                      help="how many processes this agent can run, the number of CPUs by default")
+
+    parser.add_option("--agent-address", dest="agent_addresses", action='append',
+                      help="runs as the coordinator of the agent at this address, can be repeated")
+
+    parser.add_option("--command", dest="command",
+                      help="with --agent-address, runs a command on the agents and exits: status, stop, start:ID, kill:ID or replace:ID")
+
+    parser.add_option("--profile-startup", dest="profile_startup", action='store_true', default=False,
+                      help="writes to stderr the time spent in imports, parsing, expressions and until the first spawn")
     return parser
 
 def usage():
     print ('usage: primo.py [xml config file]')
 
 def main():
+    profile = StartupProfile(STARTUP_TIME)
+    profile.mark('imports')
+
     if len(sys.argv) < 2:
         usage()
         return 
     
     options, _ = SetupCommandLine().parse_args()
 
+    if options.profile_startup:
+        profile.mark('command line')
+    else:
+        profile = None
+
     #
     # option must respect syntax name=value, like
     # primo.py test.xml --parameter xpto=10 --parameter foo=bar
@@ -975,14 +3542,35 @@ def main():
     else:
         cmdline_params = {}
     
-    x = XmlConfigParser(cmdline_params)
+    x = XmlConfigParser(cmdline_params, profile)
     primo = x.parse_file(sys.argv[1])
 
+    if profile:
+        profile.mark('parsing')
+
+    if options.state_journal:
+        primo.setup_state_journal(options.state_journal)
+
+    if options.event_log:
+        primo.setup_event_log(options.event_log)
+
+    if options.agent:
+        primo.setup_agent(options.agent, options.capacity)
+    elif options.agent_addresses:
+        primo.setup_coordinator(options.agent_addresses)
+
+        if options.command:
+            import json
+            print(json.dumps(primo.cluster.command(options.command), indent=1, sort_keys=True))
+            primo.cluster.detach()
+            return
+
     if options.debug:
+        from pprint import pprint
         for id, p in primo.processes.items():
             print (pprint( (id, p, p.listeners, p.command_line_parameters) ))
 
-    print ('running...')
+    primo.event_sink.emit('running')
     primo.run()    
 
 if __name__ == '__main__':